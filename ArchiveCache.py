@@ -0,0 +1,160 @@
+# ArchiveCache keeps downloaded archives on disk so that the same study or series can be
+# sent to several destinations while only downloading it once
+#
+# Archives are keyed by source interface and the item's UID (or its resource id on the
+# source); items with neither are never cached.  The cache holds at most max_bytes and
+# evicts the least recently used archives first.
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+
+class ArchiveCache(object):
+
+    # Caches are shared by every interface configured with the same directory
+    caches = {}
+    caches_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, cache_dir, max_bytes=None):
+        cache_dir = os.path.abspath(cache_dir)
+        with cls.caches_lock:
+            if not cls.caches.get(cache_dir):
+                cls.caches[cache_dir] = ArchiveCache(cache_dir, max_bytes)
+            return cls.caches[cache_dir]
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes or 10 * 1024 ** 3
+        self.lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.info('Opened archive cache %s (%s bytes)', cache_dir, self.max_bytes)
+
+    def get(self, interface, item, fn):
+        # Copies the cached archive for an item to fn; returns False on a miss.  It is never
+        # linked, since whoever writes to fn next would overwrite the cached archive too.
+        path = self.path(interface, item)
+        if path is None:
+            return False
+        with self.lock:
+            if not os.path.isfile(path):
+                return False
+            # Touch it, so it is the most recently used
+            os.utime(path, None)
+            if os.path.exists(fn):
+                os.remove(fn)
+            shutil.copyfile(path, fn)
+        self.logger.debug('Cache hit for %s', item)
+        return True
+
+    def put(self, interface, item, fn):
+        # Adds the archive at fn to the cache, evicting older archives to make room
+        path = self.path(interface, item)
+        if path is None:
+            self.logger.debug('Not caching %s, it has no UID or resource id', item)
+            return
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        os.close(tmp_fd)
+        shutil.copyfile(fn, tmp_path)
+        with self.lock:
+            os.rename(tmp_path, path)
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.zip'):
+                stat = os.stat(os.path.join(self.cache_dir, f))
+                entries.append((stat.st_mtime, stat.st_size, f))
+        entries.sort()
+
+        total = sum(entry[1] for entry in entries)
+        while entries and total > self.max_bytes:
+            mtime, size, f = entries.pop(0)
+            self.logger.debug('Evicting %s (%s bytes)', f, size)
+            os.remove(os.path.join(self.cache_dir, f))
+            total -= size
+
+    def path(self, interface, item):
+        key = item.uid_key(interface)
+        if key is None:
+            return None
+        key = '%s|%s' % (interface.name, key)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.zip')
+
+
+def link_or_copy(src, dst):
+    # Hard links are free, but only work within one filesystem
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+
+def test_archive_cache():
+
+    logger = logging.getLogger(test_archive_cache.__name__)
+
+    from Polynym import DicomSeries, DicomStudy, DicomSubject
+
+    class DummyInterface(object):
+        name = 'dummy'
+
+    cache_dir = 'archive_cache_tmp'
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    iface = DummyInterface()
+    cache = ArchiveCache(cache_dir, max_bytes=2500)
+
+    subject = DicomSubject(subject_id='ZA4VSDAUSJQA6', anonymized=True)
+    study = DicomStudy(study_id='554XZAIY6AW7W', subject=subject, anonymized=True)
+    worklist = [DicomSeries(series_id=str(i), study=study, anonymized=True) for i in range(3)]
+
+    assert not cache.get(iface, worklist[0], 'cache_tmp_archive.zip')
+
+    for series in worklist:
+        with open('cache_tmp_archive.zip', 'wb') as f:
+            f.write(b'x' * 1000)
+        cache.put(iface, series, 'cache_tmp_archive.zip')
+        # Keep the first one in use
+        cache.get(iface, worklist[0], 'cache_tmp_archive.zip')
+
+    logger.debug(os.listdir(cache_dir))
+    assert cache.get(iface, worklist[0], 'cache_tmp_archive.zip')
+    assert not cache.get(iface, worklist[1], 'cache_tmp_archive.zip')
+    assert cache.get(iface, worklist[2], 'cache_tmp_archive.zip')
+    assert os.path.getsize('cache_tmp_archive.zip') == 1000
+
+    # Writing over a file that was served from the cache leaves the cache alone
+    with open('cache_tmp_archive.zip', 'wb') as f:
+        f.write(b'y' * 1000)
+    assert cache.get(iface, worklist[2], 'cache_tmp_archive.zip')
+    with open('cache_tmp_archive.zip', 'rb') as f:
+        assert f.read() == b'x' * 1000
+
+    # Studies with only a placeholder accession are keyed by UID, or not cached at all
+    other_subject = DicomSubject(subject_id='PWJ7LZ3QJ4CL6', anonymized=True)
+    study_a = DicomStudy(study_id='No ID', study_uid='1.2.3', subject=subject, anonymized=True)
+    study_b = DicomStudy(study_id='No ID', study_uid='1.2.4', subject=other_subject, anonymized=True)
+    cache.put(iface, study_a, 'cache_tmp_archive.zip')
+    assert not cache.get(iface, study_b, 'cache_tmp_archive.zip')
+    study_c = DicomStudy(study_id='No ID', subject=other_subject, anonymized=True)
+    cache.put(iface, study_c, 'cache_tmp_archive.zip')
+    assert not cache.get(iface, study_c, 'cache_tmp_archive.zip')
+
+    os.remove('cache_tmp_archive.zip')
+    shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    test_archive_cache()
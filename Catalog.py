@@ -0,0 +1,321 @@
+# Catalog is a persistent, indexed SQLite store of subject, study, and series metadata
+# and of the per-interface ids that Polynym tracks as item['study_id', interface]
+#
+# Interfaces configured with a 'catalog' path record every node they build, so they
+# can answer lookups by resource id, and find by PatientID, AccessionNumber,
+# StudyInstanceUID, or SeriesInstanceUID, without any REST calls.
+#
+# Nodes are keyed by their DICOM UID, or failing that by one of their resource ids, never
+# by accession numbers or labels, which different studies may share.
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+from Polynym import DicomSeries, DicomStudy, DicomSubject
+
+
+class Catalog(object):
+
+    # Catalogs are shared by every interface configured with the same file
+    catalogs = {}
+    catalogs_lock = threading.Lock()
+
+    # Pending writes are committed in batches
+    commit_every = 500
+
+    # Catalogs written with an older schema are rebuilt (they are only a cache)
+    schema_version = 2
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS subjects (
+            key TEXT PRIMARY KEY, subject_id TEXT, subject_name TEXT, dob TEXT,
+            project_id TEXT, anonymized INTEGER);
+        CREATE TABLE IF NOT EXISTS studies (
+            key TEXT PRIMARY KEY, subject_key TEXT, study_id TEXT, accession_number TEXT,
+            study_uid TEXT, anonymized INTEGER);
+        CREATE TABLE IF NOT EXISTS series (
+            key TEXT PRIMARY KEY, study_key TEXT, series_id TEXT, anonymized INTEGER);
+        CREATE TABLE IF NOT EXISTS ids (
+            level TEXT, interface TEXT, resource_id TEXT, node_key TEXT,
+            PRIMARY KEY (level, interface, resource_id));
+        CREATE TABLE IF NOT EXISTS state (
+            name TEXT PRIMARY KEY, value TEXT);
+        CREATE INDEX IF NOT EXISTS subjects_subject_id ON subjects (subject_id);
+        CREATE INDEX IF NOT EXISTS studies_study_uid ON studies (study_uid);
+        CREATE INDEX IF NOT EXISTS studies_accession_number ON studies (accession_number);
+        CREATE INDEX IF NOT EXISTS studies_subject_key ON studies (subject_key);
+        CREATE INDEX IF NOT EXISTS series_series_id ON series (series_id);
+        CREATE INDEX IF NOT EXISTS series_study_key ON series (study_key);
+        CREATE INDEX IF NOT EXISTS ids_node_key ON ids (node_key);
+        """
+
+    # DICOM query keys that can be answered from the catalog
+    query_columns = {'PatientID':         'subjects.subject_id',
+                     'PatientName':       'subjects.subject_name',
+                     'AccessionNumber':   'studies.accession_number',
+                     'StudyInstanceUID':  'studies.study_uid',
+                     'SeriesInstanceUID': 'series.series_id'}
+
+    @classmethod
+    def open(cls, fn):
+        fn = os.path.abspath(fn)
+        with cls.catalogs_lock:
+            if not cls.catalogs.get(fn):
+                cls.catalogs[fn] = Catalog(fn)
+            return cls.catalogs[fn]
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(fn, check_same_thread=False)
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] < self.schema_version:
+            self.conn.executescript('DROP TABLE IF EXISTS subjects; DROP TABLE IF EXISTS studies; '
+                                    'DROP TABLE IF EXISTS series; DROP TABLE IF EXISTS ids;')
+            self.conn.execute('PRAGMA user_version = %d' % self.schema_version)
+        self.conn.executescript(self.schema)
+        self.pending = 0
+        atexit.register(self.commit)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.info('Opened catalog %s', fn)
+
+    # -----------------------------
+    # Public API:
+    # - add
+    # - remove
+    # - lookup
+    # - find
+    # - get_state
+    # - set_state
+    # - commit
+    # -----------------------------
+
+    def add(self, item):
+        # Records a node, its parents, and any of its per-interface ids.  Nodes with
+        # neither a UID nor a resource id can't be told apart, so they are left out.
+        with self.lock:
+            key = self.node_key(item)
+            if key is None:
+                self.logger.debug('Not cataloguing %s, it has no UID or resource id', item)
+                return
+            if isinstance(item, DicomSeries):
+                self.add(item.study)
+                self.conn.execute('INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?)',
+                                  (key, self.node_key(item.study), item.series_id, item.anonymized))
+                level = 'series'
+            elif isinstance(item, DicomStudy):
+                self.add(item.subject)
+                self.conn.execute('INSERT OR REPLACE INTO studies VALUES (?, ?, ?, ?, ?, ?)',
+                                  (key, self.node_key(item.subject), item.study_id,
+                                   item.get('accession_number'), item.get('study_uid'), item.anonymized))
+                level = 'study'
+            elif isinstance(item, DicomSubject):
+                self.conn.execute('INSERT OR REPLACE INTO subjects VALUES (?, ?, ?, ?, ?, ?)',
+                                  (key, item.subject_id, item.get('subject_name'), item.get('dob'),
+                                   item.project_id, item.anonymized))
+                level = 'subject'
+            else:
+                self.logger.warn('Unknown item type requested for catalog')
+                return
+
+            for k, v in item.iteritems():
+                # Per-interface ids are keyed as (id_name, interface)
+                if isinstance(k, tuple) and len(k) == 2 and k[0] == item.id_key and hasattr(k[1], 'name') \
+                        and isinstance(v, (basestring, int)):
+                    self.conn.execute('INSERT OR REPLACE INTO ids VALUES (?, ?, ?, ?)',
+                                      (level, k[1].name, v, key))
+            self.written()
+
+    def remove(self, level, interface, resource_id):
+        # Forgets an interface's id for a node, eg. after it is deleted from that interface
+        with self.lock:
+            self.conn.execute('DELETE FROM ids WHERE level=? AND interface=? AND resource_id=?',
+                              (level, interface.name, resource_id))
+            self.written()
+
+    def lookup(self, level, interface, resource_id):
+        # Returns the node with this id on the interface, or None if it isn't catalogued
+        with self.lock:
+            row = self.conn.execute('SELECT node_key FROM ids WHERE level=? AND interface=? AND resource_id=?',
+                                    (level, interface.name, resource_id)).fetchone()
+            if row is None:
+                return None
+            return self.node(level, row[0], interface, {})
+
+    def find(self, level, query, interface=None):
+        # Returns a worklist of nodes at this level matching all the (exact) query values.
+        # If an interface is given, only nodes it holds are returned, with its ids attached.
+        # Raises ValueError for a query key the catalog doesn't index.
+        where = []
+        values = []
+        for k, v in query.iteritems():
+            if k not in self.query_columns:
+                raise ValueError('Catalog cannot query on %s' % k)
+            where.append('%s=?' % self.query_columns[k])
+            values.append(v)
+
+        table = {'subject': 'subjects', 'study': 'studies', 'series': 'series'}[level]
+        sql = 'SELECT DISTINCT %s.key FROM subjects ' \
+              'LEFT JOIN studies ON studies.subject_key=subjects.key ' \
+              'LEFT JOIN series ON series.study_key=studies.key' % table
+        if interface is not None:
+            sql += ' JOIN ids ON ids.node_key=%s.key AND ids.level=? AND ids.interface=?' % table
+            values = [level, interface.name] + values
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        with self.lock:
+            keys = [row[0] for row in self.conn.execute(sql, values).fetchall() if row[0]]
+            nodes = {}
+            return [self.node(level, key, interface, nodes) for key in keys]
+
+    def get_state(self, name, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM state WHERE name=?', (name,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def set_state(self, name, value):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (name, value))
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+
+    # -----------------------------
+    # Private/Hidden Helpers
+    # - node_key
+    # - node
+    # - written
+    # -----------------------------
+
+    @staticmethod
+    def node_key(item):
+        # The node's UID if it has one, otherwise its resource id on the first interface
+        # (by name) that holds it
+        key = item.uid_key()
+        if key is None:
+            interfaces = sorted((k[1] for k in item if isinstance(k, tuple) and k[0] == item.id_key
+                                 and hasattr(k[1], 'name')), key=lambda i: i.name)
+            for interface in interfaces:
+                key = item.uid_key(interface)
+                if key is not None:
+                    break
+        return key
+
+    def node(self, level, key, interface, nodes):
+        # Rebuilds a node (and its parents) from the catalog; nodes caches the ones already
+        # built, so siblings share their parents
+        if key in nodes:
+            return nodes[key]
+
+        if level == 'series':
+            study_key, series_id, anonymized = self.conn.execute(
+                'SELECT study_key, series_id, anonymized FROM series WHERE key=?', (key,)).fetchone()
+            kwargs = {'series_id': series_id, 'anonymized': bool(anonymized)}
+            if study_key is not None:
+                kwargs['study'] = self.node('study', study_key, interface, nodes)
+            item = DicomSeries(**kwargs)
+        elif level == 'study':
+            subject_key, study_id, accession_number, study_uid, anonymized = self.conn.execute(
+                'SELECT subject_key, study_id, accession_number, study_uid, anonymized FROM studies WHERE key=?',
+                (key,)).fetchone()
+            kwargs = {'study_id': study_id, 'anonymized': bool(anonymized)}
+            if subject_key is not None:
+                kwargs['subject'] = self.node('subject', subject_key, interface, nodes)
+            if accession_number:
+                kwargs['accession_number'] = accession_number
+            if study_uid:
+                kwargs['study_uid'] = study_uid
+            item = DicomStudy(**kwargs)
+        else:
+            subject_id, subject_name, dob, project_id, anonymized = self.conn.execute(
+                'SELECT subject_id, subject_name, dob, project_id, anonymized FROM subjects WHERE key=?',
+                (key,)).fetchone()
+            kwargs = {'subject_id': subject_id, 'project_id': project_id, 'anonymized': bool(anonymized)}
+            if subject_name:
+                kwargs['subject_name'] = subject_name
+            if dob:
+                kwargs['dob'] = dob
+            item = DicomSubject(**kwargs)
+
+        if interface is not None:
+            for (resource_id,) in self.conn.execute(
+                    'SELECT resource_id FROM ids WHERE node_key=? AND interface=?', (key, interface.name)):
+                item['%s_id' % level, interface] = resource_id
+
+        nodes[key] = item
+        return item
+
+    def written(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+
+def test_catalog():
+
+    logger = logging.getLogger(test_catalog.__name__)
+
+    class DummyInterface(object):
+        name = 'dummy'
+
+    fn = 'catalog_tmp.sqlite'
+    if os.path.exists(fn):
+        os.remove(fn)
+
+    iface = DummyInterface()
+    catalog = Catalog(fn)
+
+    subject = DicomSubject(subject_id='ZA4VSDAUSJQA6', anonymized=True)
+    subject['subject_id', iface] = 'patient-a'
+    study = DicomStudy(study_id='554XZAIY6AW7W', study_uid='1.2.3', subject=subject, anonymized=True)
+    series = DicomSeries(series_id='XYZ', study=study, anonymized=True)
+    series['series_id', iface] = 'abcd-1234'
+    catalog.add(series)
+
+    # Studies without accession numbers are still kept apart
+    for name in 'AB':
+        other_subject = DicomSubject(subject_id='No ID', subject_name=name, anonymized=True)
+        other_subject['subject_id', iface] = 'patient-%s' % name
+        other_study = DicomStudy(study_id='No ID', subject=other_subject, anonymized=True)
+        other_study['study_id', iface] = 'uuid-%s' % name
+        catalog.add(other_study)
+    catalog.commit()
+
+    item = Catalog(fn).lookup('series', iface, 'abcd-1234')
+    logger.debug(item)
+    assert item.series_id == 'XYZ'
+    assert item['series_id', iface] == 'abcd-1234'
+    assert item.study.study_id == '554XZAIY6AW7W'
+    assert item.subject.subject_id == 'ZA4VSDAUSJQA6'
+
+    worklist = catalog.find('series', {'PatientID': 'ZA4VSDAUSJQA6'}, iface)
+    assert [s.series_id for s in worklist] == ['XYZ']
+    assert catalog.find('study', {'SeriesInstanceUID': 'None'}) == []
+    assert [s.study_id for s in catalog.find('study', {'StudyInstanceUID': '1.2.3'})] == ['554XZAIY6AW7W']
+    try:
+        catalog.find('study', {'StudyDescription': 'CT HEAD'})
+        assert False, 'Expected ValueError'
+    except ValueError:
+        pass
+
+    item = catalog.lookup('study', iface, 'uuid-A')
+    assert item['study_id', iface] == 'uuid-A'
+    assert item.subject.get('subject_name') == 'A'
+
+    catalog.set_state('changes', 42)
+    assert int(catalog.get_state('changes')) == 42
+
+    os.remove(fn)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    test_catalog()
@@ -10,11 +10,19 @@ class DICOMInterface(Interface):
         super(DICOMInterface, self).__init__(**kwargs)
 
     def find(self, level, question, source=None):
+        # Queries and retrieves are relayed by the proxy, which holds them to this
+        # interface's rate limit and feeds their latency to its limiter
         return self.proxy.find(level, question, self)
 
-    def download_data(self, item):
-        self.proxy.copy(item, self, self.proxy)
-        self.proxy.download_data(item)
+    def download_data(self, item, fn=None):
+        # The proxy retrieves the item from the modality, then its local copy is downloaded
+        retrieved = self.proxy.retrieve(item, self)
+        if not retrieved:
+            raise IOError('Retrieving %s put nothing on %s' % (item, self.proxy.name))
+        if len(retrieved) > 1:
+            raise IOError('Retrieving %s matched %s items on %s' % (item, len(retrieved), self.proxy.name))
+        self.proxy.download_data(retrieved[0], fn)
+        item.data = retrieved[0].data
 
 
 def dicom_tests():
@@ -2,8 +2,20 @@ import logging
 import zipfile
 import os
 import io
+import tempfile
+import threading
+import time
+import shutil
+import re
+import Queue
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from SessionWrapper import SessionWrapper, JuniperSessionWrapper
+from Catalog import Catalog
+from Polynym import DicomStudy, DicomSubject, placeholder_ids
+from ArchiveCache import ArchiveCache, link_or_copy
+from Throttle import AdaptiveLimiter
 
 
 class Interface(object):
@@ -37,7 +49,8 @@ class Interface(object):
             return OrthancInterface(name=name, **config)
         elif config['type'] == 'dicom':
             proxy = Interface.factory(config['proxy'], _config)
-            return DICOMInterface(name=name, proxy=proxy, **_config)
+            config = dict(config, proxy=proxy)
+            return DICOMInterface(name=name, **config)
         elif config['type'] == 'montage':
             return MontageInterface(name=name, **config)
         elif config['type'] == 'tcia':
@@ -62,17 +75,35 @@ class Interface(object):
         self.proxy = kwargs.get('proxy')
         self.j_proxy = kwargs.get('j_proxy')
 
+        # Limit on concurrent transfers touching this interface; it backs off when the
+        # server answers 429/503 or slower than target_latency, and recovers gradually
+        self.max_connections = kwargs.get('max_connections', 4)
+        self.transfer_slots = AdaptiveLimiter(self.max_connections, target_latency=kwargs.get('target_latency'))
+
         # Create a session/juniper session
         if self.j_proxy is None:
             self.session = SessionWrapper(**kwargs)
         else:
             self.session = JuniperSessionWrapper(**kwargs)
+        self.session.limiter = self.transfer_slots
 
         # Should be "available studies" plus a registry of all studies somewhere else
         self.series = {}
         self.studies = {}
         self.subjects = {}
 
+        # Optional persistent metadata catalog, shared by interfaces with the same file
+        if kwargs.get('catalog'):
+            self.catalog = Catalog.open(kwargs.get('catalog'))
+        else:
+            self.catalog = None
+
+        # Optional on-disk cache of downloaded archives, shared by interfaces with the same directory
+        if kwargs.get('archive_cache'):
+            self.archive_cache = ArchiveCache.open(kwargs.get('archive_cache'), kwargs.get('archive_cache_size'))
+        else:
+            self.archive_cache = None
+
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.info('Created interface')
 
@@ -108,13 +139,17 @@ class Interface(object):
     # - study_from_id
     # - series_from_id
     # - all_studies (optional)
+    # - changes (optional)
+    # - present_ids (optional)
     # -----------------------------
 
     # Each interface needs to implement methods for moving data around
     def upload_data(self, item):
         raise NotImplementedError
 
-    def download_data(self, item):
+    def download_data(self, item, fn=None):
+        # If fn is given, stream the archive to that path or file-like and set item.data
+        # to it, otherwise item.data holds the archive content in memory
         raise NotImplementedError
 
     # Factories for HDN types
@@ -131,62 +166,314 @@ class Interface(object):
     def all_studies(self):
         raise NotImplementedError
 
+    # Optional feed of items that changed since a sequence number, for incremental work;
+    # returns (worklist, last, done)
+    def changes(self, since=0, level='study', limit=None):
+        raise NotImplementedError
+
+    # Optional bulk listing of the identifiers of everything on this interface at a level,
+    # for skipping items that are already present.  Identifiers are tuples as made by
+    # item_ids: ('uid', UID), ('study', PatientID, accession number or label), or
+    # ('subject', PatientID).
+    def present_ids(self, level):
+        raise NotImplementedError
+
     # -----------------------------
     # Baseclass Public API:
+    # - find_in_catalog
+    # - dedup
     # - copy
+    # - copy_item
     # - move
+    # - pipe
     # - upload_archive
     # - download_archive
     # -----------------------------
 
-    def copy(self, worklist, source, target, anonymize=False):
+    def find_in_catalog(self, level, query):
+        # Answers exact PatientID, PatientName, AccessionNumber, StudyInstanceUID, or
+        # SeriesInstanceUID queries for items on this interface from the catalog, without
+        # any REST calls; other query keys raise ValueError
+        if self.catalog is None:
+            self.logger.warn('No catalog configured')
+            return []
+        return self.catalog.find(level, query, self)
+
+    def dedup(self, worklist, target, journal=None):
+        # Drops items that the target already holds, checked against one bulk listing of
+        # the target's identifiers per level.  Items found are marked verified in the journal.
+        if isinstance(worklist, dict):
+            worklist = [worklist]
+
+        present = {}
+        remaining = []
+        for item in worklist:
+            level = item_level(item)
+            if level not in present:
+                try:
+                    present[level] = set(target.present_ids(level))
+                except NotImplementedError:
+                    self.logger.warn('%s cannot list present %s items', target.name, level)
+                    present[level] = set()
+
+            if item_ids(item) & present[level]:
+                self.logger.debug('Skipping %s, already on %s', item, target.name)
+                if journal:
+                    journal.set(item, self, target, 'verified')
+            else:
+                remaining.append(item)
+
+        self.logger.info('%s items are not yet on %s', len(remaining), target.name)
+        return remaining
+
+    def copy(self, worklist, source, target, anonymize=False, max_workers=1, journal=None):
         # Sends data for items in WORKLIST from the source to the target
         # if the source is self and the target is a string/file, it downloads
         # if the source is a string/file and the target is self, it uploads
         # if the source is a DICOM node and the target is self, it retrieves
+        #
+        # With max_workers > 1 the items are run on a thread pool, each holding a transfer
+        # slot on every interface involved.  Returns a list of {'item', 'error'} results.
+        # With a journal, items that already reached the target are skipped.
 
         # TODO: Create anonymized study if necessary and delete it when done
 
-        if not isinstance(worklist, list):
+        if isinstance(worklist, dict):
             worklist = [worklist]
 
-        for item in worklist:
-            # Figure out case
-            if isinstance(source, basestring) and (target is None or target is self):
-                # It's probably a file being uploaded
-                self.upload_archive(item, source)
-            elif source is self and isinstance(target, basestring):
-                # It's probably a file being downloaded
-                self.download_archive(item, target)
-            elif source is self:
-                # Sending to DICOM modality or Orthanc peer
-                self.send(item, target)
-            elif target is self:
-                self.retrieve(item, source)
-
-    def move(self, worklist, source, target, anonymize=False):
-        self.copy(worklist, source, target, anonymize)
-        self.delete(worklist)
+        def copy_item(item):
+            if journal and journal.reached(item, source, target, 'uploaded'):
+                self.logger.debug('Skipping %s, already copied', item)
+                return {'item': item, 'error': None}
+            try:
+                with acquire_transfer_slots(self, source, target):
+                    self.copy_item(item, source, target)
+                if journal:
+                    journal.set(item, source, target, 'uploaded')
+                return {'item': item, 'error': None}
+            except Exception as e:
+                self.logger.error('Failed to copy %s: %s', item, e)
+                return {'item': item, 'error': e}
+
+        if max_workers > 1:
+            pool = ThreadPool(max_workers)
+            try:
+                results = pool.map(copy_item, worklist)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [copy_item(item) for item in worklist]
+
+        failed = len([r for r in results if r['error'] is not None])
+        if failed:
+            self.logger.warn('%s of %s items failed to copy', failed, len(results))
+        return results
+
+    def copy_item(self, item, source, target):
+        # Figure out case
+        if isinstance(source, basestring) and (target is None or target is self):
+            # It's probably a file being uploaded
+            self.upload_archive(item, source)
+        elif source is self and isinstance(target, basestring):
+            # It's probably a file being downloaded
+            self.download_archive(item, target)
+        elif source is self:
+            # Sending to DICOM modality or Orthanc peer
+            self.send(item, target)
+        elif target is self:
+            self.retrieve(item, source)
+        else:
+            raise ValueError('Cannot copy from %s to %s' % (target_name(source), target_name(target)))
+
+    def move(self, worklist, source, target, anonymize=False, max_workers=1, journal=None):
+        results = self.copy(worklist, source, target, anonymize, max_workers, journal)
+        copied = [r['item'] for r in results if r['error'] is None]
+        if journal:
+            copied = [item for item in copied if not journal.reached(item, source, target, 'deleted')]
+        if copied:
+            self.delete(copied)
+        if journal:
+            for item in copied:
+                journal.set(item, source, target, 'deleted')
+        return results
+
+    def pipe(self, worklist, target, max_workers=1, queue_depth=2, tmp_dir=None, journal=None):
+        # Pipelined copy from self to a target interface.  Download workers stream archives
+        # into tmp_dir and feed a bounded queue that upload workers on the target drain, so
+        # both links stay busy.  At most queue_depth + 2 * max_workers archives are on disk
+        # at once: queue_depth waiting, plus one per download and one per upload worker.
+        #
+        # The target may also be a list of interfaces and/or local directories, in which case
+        # each item is downloaded once and then uploaded to all of them concurrently.
+        # Returns a list of {'item', 'error', 'targets'} results, where 'targets' maps each
+        # target name to its error (or None) and 'error' is the first of those.
+        #
+        # With a journal, items already uploaded are skipped, and downloads are staged
+        # beside the journal so that a rerun uploads them without downloading again.
+
+        if isinstance(worklist, dict):
+            worklist = [worklist]
+        worklist = iter(worklist)
+        worklist_lock = threading.Lock()
+
+        if isinstance(target, list):
+            targets = target
+        else:
+            targets = [target]
+
+        staged = Queue.Queue(maxsize=queue_depth)
+        if journal:
+            staging_dir = journal.staging_dir
+        else:
+            staging_dir = tempfile.mkdtemp(prefix='tithonus-', dir=tmp_dir)
+        results = []
+
+        def next_item():
+            with worklist_lock:
+                return next(worklist, None)
+
+        def download():
+            while True:
+                item = next_item()
+                if item is None:
+                    break
+
+                todo = targets
+                if journal:
+                    todo = [t for t in targets if not journal.reached(item, self, t, 'uploaded')]
+                    if not todo:
+                        results.append({'item': item, 'error': None, 'targets': {}})
+                        continue
+                    resumed = [fn for state, fn in [journal.get(item, self, t) for t in todo]
+                               if state == 'downloaded' and os.path.isfile(fn)]
+                    if resumed:
+                        self.logger.debug('Resuming %s from %s', item, resumed[0])
+                        staged.put((item, resumed[0], todo))
+                        continue
+
+                # Each download gets a directory of its own, so no two can pick the same name
+                fn = os.path.join(tempfile.mkdtemp(dir=staging_dir), 'archive')
+                try:
+                    with acquire_transfer_slots(self):
+                        self.download_archive(item, fn)
+                    if not os.path.isfile(fn + '.zip'):
+                        raise IOError('Download produced no archive')
+                except Exception as e:
+                    self.logger.error('Failed to download %s: %s', item, e)
+                    shutil.rmtree(os.path.dirname(fn), ignore_errors=True)
+                    results.append({'item': item, 'error': e,
+                                    'targets': dict((target_name(t), e) for t in todo)})
+                    continue
+                if journal:
+                    for t in todo:
+                        journal.set(item, self, t, 'downloaded', fn + '.zip')
+                # Blocks while the upload side is behind
+                staged.put((item, fn + '.zip', todo))
+
+        def upload_to(item, fn, t):
+            try:
+                with acquire_transfer_slots(t):
+                    if isinstance(t, basestring):
+                        # A local directory
+                        if not os.path.isdir(t):
+                            os.makedirs(t)
+                        link_or_copy(fn, os.path.join(t, archive_name(item, self)))
+                    else:
+                        t.upload_archive(item, fn)
+                if journal:
+                    journal.set(item, self, t, 'uploaded')
+                return None
+            except Exception as e:
+                self.logger.error('Failed to upload %s to %s: %s', item, target_name(t), e)
+                return e
+
+        def upload():
+            while True:
+                entry = staged.get()
+                if entry is None:
+                    break
+                item, fn, todo = entry
+
+                if len(todo) > 1:
+                    pool = ThreadPool(len(todo))
+                    try:
+                        errors = pool.map(lambda t: upload_to(item, fn, t), todo)
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    errors = [upload_to(item, fn, todo[0])]
+
+                error = ([e for e in errors if e is not None] or [None])[0]
+                results.append({'item': item, 'error': error,
+                                'targets': dict((target_name(t), e) for t, e in zip(todo, errors))})
+                if error is None or not journal:
+                    os.remove(fn)
+                    if os.path.dirname(fn) != staging_dir:
+                        os.rmdir(os.path.dirname(fn))
+
+        downloaders = [threading.Thread(target=download) for i in range(max_workers)]
+        uploaders = [threading.Thread(target=upload) for i in range(max_workers)]
+        for t in downloaders + uploaders:
+            t.daemon = True
+            t.start()
+
+        try:
+            for t in downloaders:
+                t.join()
+        finally:
+            for t in uploaders:
+                staged.put(None)
+            for t in uploaders:
+                t.join()
+            if not journal:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+        failed = len([r for r in results if r['error'] is not None])
+        if failed:
+            self.logger.warn('%s of %s items failed to transfer', failed, len(results))
+        return results
 
     def upload_archive(self, item, fn):
+        # item.data is handed to upload_data as an open file, so the request body is
+        # streamed from disk rather than read into memory; folders are zipped to a temp file
         if os.path.isdir(fn):
             self.logger.info('Uploading image folder %s', fn)
-            item.data = self.zipdir(fn)
+            f = tempfile.TemporaryFile()
+            self.zipdir(fn, f)
+            f.seek(0)
         elif os.path.isfile(fn):
             self.logger.info('Uploading image archive %s', fn)
             f = open(fn, 'rb')
-            item.data = f.read()
-            f.close()
+        else:
+            raise IOError('No image folder or archive at %s' % fn)
 
-        self.upload_data(item)
+        item.data = f
+        try:
+            self.upload_data(item)
+        finally:
+            f.close()
+            item.data = None
 
     def download_archive(self, item, fn):
         self.logger.info('Downloading image archive %s', fn)
-        self.download_data(item)
-        if fn is not None:
-            f = open(fn + '.zip', 'wb')
-            f.write(item.data)
-            f.close()
+        if fn is None:
+            self.download_data(item)
+            if item.data is None:
+                raise IOError('Download of %s returned no data' % item)
+            return
+
+        fn = fn + '.zip'
+        if self.archive_cache is not None and self.archive_cache.get(self, item, fn):
+            item.data = fn
+            return
+
+        self.download_data(item, fn)
+        if not os.path.isfile(fn):
+            raise IOError('Download of %s produced no archive' % item)
+        if self.archive_cache is not None:
+            self.archive_cache.put(self, item, fn)
 
     # -----------------------------
     # Private/Hidden Helpers
@@ -194,8 +481,10 @@ class Interface(object):
     # - do_post
     # - do_put
     # - do_delete
+    # - do_stream
     # - do_return
     # - zipdir
+    # - from_catalog
     # -----------------------------
 
     def do_return(self, r):
@@ -207,6 +496,9 @@ class Interface(object):
     def do_get(self, *url, **kwargs):
         return self.session.do_get(*url, **kwargs)
 
+    def do_stream(self, *url, **kwargs):
+        return self.session.do_stream(*url, **kwargs)
+
     def do_put(self, *url, **kwargs):
         return self.session.do_put(*url, **kwargs)
 
@@ -218,10 +510,10 @@ class Interface(object):
         file_like_object = io.BytesIO()
         if fno is None:
             self.logger.info('Creating in-memory zip')
-            zipf = zipfile.ZipFile(file_like_object, 'w', zipfile.ZIP_DEFLATED)
+            zipf = zipfile.ZipFile(file_like_object, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
         else:
             self.logger.info('Creating zip file')
-            zipf = zipfile.ZipFile(fno, 'w', zipfile.ZIP_DEFLATED)
+            zipf = zipfile.ZipFile(fno, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
 
         for dirpath, dirnames, filenames in os.walk(top):
             for f in filenames:
@@ -234,6 +526,238 @@ class Interface(object):
         if fno is None:
             return file_like_object.getvalue()
 
+    def from_catalog(self, level, resource_id):
+        # Returns the catalogued node for a resource on this interface, and indexes it
+        if self.catalog is None:
+            return None
+        item = self.catalog.lookup(level, self, resource_id)
+        if item is not None:
+            index = {'subject': self.subjects, 'study': self.studies, 'series': self.series}[level]
+            index[resource_id] = item
+        return item
+
+
+# Interfaces each thread already holds a transfer slot on
+held_slots = threading.local()
+
+
+@contextmanager
+def acquire_transfer_slots(*interfaces):
+    # Hold a transfer slot on each distinct interface; slots are always taken in the
+    # same order so that concurrent transfers between the same pair can't deadlock.
+    # Slots this thread already holds (eg. in a copy nested in another) aren't taken again.
+    held = held_slots.__dict__.setdefault('interfaces', set())
+    interfaces = sorted(set(i for i in interfaces if isinstance(i, Interface) and i not in held), key=id)
+    for interface in interfaces:
+        interface.transfer_slots.acquire()
+        held.add(interface)
+    try:
+        yield
+    finally:
+        for interface in reversed(interfaces):
+            held.discard(interface)
+            interface.transfer_slots.release()
+
+
+@contextmanager
+def relayed(interface):
+    # Requests a proxy makes on an interface's behalf (eg. an Orthanc C-FIND or C-MOVE to
+    # a PACS) are held to that interface's rate limit, and their latency is fed to its
+    # limiter; a failed request counts as the server being overloaded
+    if not isinstance(interface, Interface):
+        yield
+        return
+    if interface.session.rate_limit is not None:
+        interface.session.rate_limit.acquire()
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        interface.transfer_slots.observe(time.time() - start, 503)
+        raise
+    interface.transfer_slots.observe(time.time() - start, 200)
+
+
+def target_name(target):
+    return getattr(target, 'name', target)
+
+
+def archive_name(item, source):
+    # File name for an item's archive in a local directory, unique to the item
+    key = item.uid_key(source)
+    if key is None:
+        raise IOError('%s has no UID or resource id to name its archive by' % item)
+    return re.sub(r'[^\w.-]', '_', key) + '.zip'
+
+
+def item_level(item):
+    return item.__class__.__name__.replace('Dicom', '').lower()
+
+
+def item_ids(item):
+    # All the context-free identifiers an item may be known by on another interface.
+    # Accession numbers and labels only count together with the subject's id, since
+    # another patient's study may share them; placeholders never count.
+    ids = set()
+    if item.uid:
+        ids.add(('uid', item.uid))
+    if isinstance(item, DicomStudy):
+        subject_id = item.subject.subject_id
+        for study_id in (item.get('accession_number'), item.study_id):
+            if subject_id not in placeholder_ids + (None,) and study_id not in placeholder_ids + (None,):
+                ids.add(('study', subject_id, study_id))
+    elif isinstance(item, DicomSubject):
+        if item.subject_id not in placeholder_ids + (None,):
+            ids.add(('subject', item.subject_id))
+    return ids
+
+
+class MemoryInterface(Interface):
+    # Holds archives in memory, keyed by item UID, so that transfers can be tested without
+    # a server.  Uploads of items in 'failing' raise, and 'feed' is its changes feed.
+
+    def __init__(self, **kwargs):
+        super(MemoryInterface, self).__init__(**kwargs)
+        self.items = {}
+        self.archives = {}
+        self.failing = set()
+        self.feed = []
+        self.downloads = 0
+
+    def hold(self, item, data):
+        self.items[item.uid_key()] = item
+        self.archives[item.uid_key()] = data
+
+    def download_data(self, item, fn=None):
+        data = self.archives.get(item.uid_key())
+        if data is None:
+            raise IOError('%s is not on %s' % (item, self.name))
+        self.downloads += 1
+        if fn is None:
+            item.data = data
+        else:
+            with open(fn, 'wb') as f:
+                f.write(data)
+            item.data = fn
+
+    def upload_data(self, item):
+        if item.uid in self.failing:
+            raise IOError('%s refused %s' % (self.name, item))
+        self.hold(item, item.data.read())
+
+    def send(self, item, target):
+        self.download_data(item)
+        item.data = io.BytesIO(item.data)
+        try:
+            target.upload_data(item)
+        finally:
+            item.data = None
+
+    def delete(self, worklist):
+        for item in worklist:
+            del self.items[item.uid_key()]
+            del self.archives[item.uid_key()]
+
+    def changes(self, since=0, level='study', limit=2):
+        last = min(since + limit, len(self.feed))
+        return self.feed[since:last], last, last >= len(self.feed)
+
+    def present_ids(self, level):
+        ids = set()
+        for item in self.items.itervalues():
+            if item_level(item) == level:
+                ids.update(item_ids(item))
+        return ids
+
+
+def test_copy():
+
+    from Journal import Journal
+    from Polynym import DicomSeries
+
+    tmp_dir = tempfile.mkdtemp(prefix='tithonus-')
+    source = MemoryInterface(name='source')
+    target = MemoryInterface(name='target')
+    study = DicomStudy(study_id='554XZAIY6AW7W', study_uid='1.2.3', subject_id='ZA4VSDAUSJQA6', anonymized=True)
+    worklist = [DicomSeries(series_id='1.2.3.%d' % i, study=study, anonymized=True) for i in range(4)]
+    for series in worklist[:3]:
+        source.hold(series, b'DATA-' + series.series_id)
+    target.failing.add('1.2.3.1')
+
+    # Failed copies are reported, not raised, and the rest still go through
+    journal = Journal(os.path.join(tmp_dir, 'journal.sqlite'))
+    results = source.copy(worklist, source, target, max_workers=2, journal=journal)
+    assert [r['error'] is None for r in results] == [True, False, True, False]
+    assert sorted(target.archives) == ['DicomSeries:1.2.3.0', 'DicomSeries:1.2.3.2']
+
+    # Rerun with the journal only copies what's left, and a move only deletes what arrived
+    target.failing.clear()
+    downloads = source.downloads
+    results = source.move(worklist, source, target, journal=journal)
+    assert source.downloads == downloads + 1
+    assert [r['error'] is None for r in results] == [True, True, True, False]
+    assert sorted(source.archives) == []
+    assert target.archives['DicomSeries:1.2.3.1'] == b'DATA-1.2.3.1'
+
+    # Downloads to a local path, and uploads from one
+    results = target.copy(worklist[0], target, os.path.join(tmp_dir, 'out'))
+    assert results[0]['error'] is None
+    results = source.copy(worklist[0], os.path.join(tmp_dir, 'out.zip'), source)
+    assert results[0]['error'] is None
+    assert source.archives['DicomSeries:1.2.3.0'] == b'DATA-1.2.3.0'
+
+    shutil.rmtree(tmp_dir)
+
+
+def test_pipe():
+
+    from Journal import Journal
+    from Polynym import DicomSeries
+
+    tmp_dir = tempfile.mkdtemp(prefix='tithonus-')
+    source = MemoryInterface(name='source')
+    targets = [MemoryInterface(name='a'), MemoryInterface(name='b'), os.path.join(tmp_dir, 'fan')]
+    study = DicomStudy(study_id='554XZAIY6AW7W', study_uid='1.2.3', subject_id='ZA4VSDAUSJQA6', anonymized=True)
+    worklist = [DicomSeries(series_id='1.2.3.%d' % i, study=study, anonymized=True) for i in range(3)]
+    for series in worklist:
+        source.hold(series, b'DATA-' + series.series_id)
+    targets[1].failing.add('1.2.3.1')
+
+    # Each item is downloaded once for all the targets, and failures are per target
+    journal = Journal(os.path.join(tmp_dir, 'journal.sqlite'))
+    results = source.pipe(worklist, targets, max_workers=2, journal=journal)
+    assert source.downloads == 3
+    results = dict((r['item'].series_id, r) for r in results)
+    assert results['1.2.3.0']['error'] is None
+    assert isinstance(results['1.2.3.1']['targets']['b'], IOError)
+    assert results['1.2.3.1']['targets']['a'] is None
+    assert sorted(os.listdir(targets[2])) == ['DicomSeries_1.2.3.%d.zip' % i for i in range(3)]
+
+    # A rerun resumes the failed upload from the staged download
+    targets[1].failing.clear()
+    results = source.pipe(worklist, targets, max_workers=2, journal=journal)
+    assert source.downloads == 3
+    assert [r['error'] for r in results] == [None, None, None]
+    assert targets[1].archives['DicomSeries:1.2.3.1'] == b'DATA-1.2.3.1'
+    assert os.listdir(journal.staging_dir) == []
+
+    shutil.rmtree(tmp_dir)
+
+
+def test_dedup():
+
+    source = MemoryInterface(name='source')
+    target = MemoryInterface(name='target')
+    target.hold(DicomStudy(study_id='A1', study_uid='1.2.3', subject_id='P1', anonymized=True), b'')
+
+    # Accession numbers only match within the same subject, placeholders never do
+    same_uid = DicomStudy(study_id='X9', study_uid='1.2.3', subject_id='P3', anonymized=True)
+    same_accession = DicomStudy(study_id='A1', subject_id='P1', anonymized=True)
+    other_subject = DicomStudy(study_id='A1', subject_id='P2', anonymized=True)
+    no_id = DicomStudy(study_id='No ID', subject_id='P1', anonymized=True)
+    remaining = source.dedup([same_uid, same_accession, other_subject, no_id], target)
+    assert [id(item) for item in remaining] == [id(other_subject), id(no_id)]
+
 
 def interface_tests():
 
@@ -251,6 +775,9 @@ def interface_tests():
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
+    test_copy()
+    test_pipe()
+    test_dedup()
     interface_tests()
 
 
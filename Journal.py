@@ -0,0 +1,128 @@
+# Journal is a durable, per-item record of transfer progress, kept in SQLite
+#
+# Each item moves through pending -> downloaded -> uploaded -> verified -> deleted for a
+# given source and target, so a copy, move, or pipe that is interrupted can be rerun
+# and will skip whatever was already finished, and resume from staged downloads.
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+
+
+class Journal(object):
+
+    states = ['pending', 'downloaded', 'uploaded', 'verified', 'deleted']
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS journal (
+            item TEXT, source TEXT, target TEXT, state TEXT, path TEXT,
+            PRIMARY KEY (item, source, target));
+        """
+
+    def __init__(self, fn):
+        self.fn = os.path.abspath(fn)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.fn, check_same_thread=False)
+        self.conn.executescript(self.schema)
+        atexit.register(self.conn.commit)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.info('Opened journal %s', self.fn)
+
+    @property
+    def staging_dir(self):
+        # Downloads staged by a journaled pipe are kept here, so they survive a restart
+        staging_dir = self.fn + '.staging'
+        if not os.path.isdir(staging_dir):
+            os.makedirs(staging_dir)
+        return staging_dir
+
+    def get(self, item, source, target):
+        # Returns (state, path) for an item, ('pending', None) if it hasn't been seen
+        key = self.key(item, source, target)
+        if key is None:
+            return 'pending', None
+        with self.lock:
+            row = self.conn.execute('SELECT state, path FROM journal WHERE item=? AND source=? AND target=?',
+                                    key).fetchone()
+        if row is None:
+            return 'pending', None
+        return row[0], row[1]
+
+    def set(self, item, source, target, state, path=None):
+        key = self.key(item, source, target)
+        if key is None:
+            self.logger.warn('Not journaling %s, it has no UID or resource id on the source', item)
+            return
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)', key + (state, path))
+            self.conn.commit()
+
+    def reached(self, item, source, target, state):
+        # True if the item has already got at least as far as state
+        return self.states.index(self.get(item, source, target)[0]) >= self.states.index(state)
+
+    @staticmethod
+    def key(item, source, target):
+        # Items are keyed by their DICOM UID, or else their resource id on the source, never
+        # by accession numbers or labels that different studies may share.  Items with
+        # neither aren't journaled at all, so they are always copied.
+        if item is None:
+            return None
+        item_key = item.uid_key(source if not isinstance(source, basestring) else None)
+        if item_key is None:
+            return None
+        names = tuple(','.join(getattr(y, 'name', y) for y in x) if isinstance(x, list) else getattr(x, 'name', x)
+                      for x in (source, target))
+        return (item_key,) + names
+
+
+def test_journal():
+
+    logger = logging.getLogger(test_journal.__name__)
+
+    from Polynym import DicomSeries, DicomStudy, DicomSubject
+
+    fn = 'journal_tmp.sqlite'
+    if os.path.exists(fn):
+        os.remove(fn)
+
+    subject = DicomSubject(subject_id='ZA4VSDAUSJQA6', anonymized=True)
+    study = DicomStudy(study_id='554XZAIY6AW7W', study_uid='1.2.3', subject=subject, anonymized=True)
+    series = DicomSeries(series_id='XYZ', study=study, anonymized=True)
+
+    journal = Journal(fn)
+    assert journal.get(series, 'orthanc', 'xnat') == ('pending', None)
+    journal.set(series, 'orthanc', 'xnat', 'downloaded', 'staged.zip')
+    journal.set(study, 'orthanc', 'xnat', 'uploaded')
+
+    journal = Journal(fn)
+    logger.debug(journal.get(series, 'orthanc', 'xnat'))
+    assert journal.get(series, 'orthanc', 'xnat') == ('downloaded', 'staged.zip')
+    assert not journal.reached(series, 'orthanc', 'xnat', 'uploaded')
+    assert journal.reached(study, 'orthanc', 'xnat', 'uploaded')
+    assert not journal.reached(study, 'orthanc', 'montage', 'uploaded')
+
+    # Studies sharing a placeholder accession number are told apart by their resource ids,
+    # and are never journaled without one
+    class DummyInterface(object):
+        name = 'orthanc'
+
+    iface = DummyInterface()
+    a = DicomStudy(study_id='No ID', subject=subject, anonymized=True)
+    b = DicomStudy(study_id='No ID', subject=subject, anonymized=True)
+    a['study_id', iface] = 'uuid-a'
+    b['study_id', iface] = 'uuid-b'
+    journal.set(a, iface, 'xnat', 'uploaded')
+    assert not journal.reached(b, iface, 'xnat', 'uploaded')
+    journal.set(DicomStudy(study_id='No ID', subject=subject, anonymized=True), iface, 'xnat', 'uploaded')
+    assert not journal.reached(DicomStudy(study_id='No ID', subject=subject, anonymized=True), iface, 'xnat', 'uploaded')
+
+    os.remove(fn)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    test_journal()
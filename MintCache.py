@@ -0,0 +1,148 @@
+# MintCache memoizes GID_Mint lookups, so each unique subject or accession number is
+# only minted once no matter how often Polynym rules fire
+#
+# Mints are kept in an in-process LRU, and optionally in a persistent SQLite store that
+# survives between runs.  Stored keys are hashed, so the store holds no PHI.
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+import GID_Mint
+
+
+class MintCache(object):
+
+    # Most recent mints kept in memory
+    max_size = 100000
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS mints (
+            key TEXT PRIMARY KEY, value TEXT);
+        """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.max_size
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = None
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def open_store(self, fn):
+        # Adds a persistent store behind the in-memory cache
+        fn = os.path.abspath(fn)
+        with self.lock:
+            self.conn = sqlite3.connect(fn, check_same_thread=False)
+            self.conn.executescript(self.schema)
+        self.logger.info('Opened mint store %s', fn)
+
+    # -----------------------------
+    # Public API, same as GID_Mint:
+    # - get_gid
+    # - get_pname_for_gid
+    # - get_pdob_for_dob_and_gid
+    # -----------------------------
+
+    def get_gid(self, params):
+        return self.mint(GID_Mint.get_gid, params)
+
+    def get_pname_for_gid(self, params):
+        return self.mint(GID_Mint.get_pname_for_gid, params)
+
+    def get_pdob_for_dob_and_gid(self, params):
+        return self.mint(GID_Mint.get_pdob_for_dob_and_gid, params)
+
+    def clear(self):
+        with self.lock:
+            self.lru.clear()
+            self.hits = 0
+            self.misses = 0
+
+    # -----------------------------
+    # Private/Hidden Helpers
+    # - mint
+    # - key
+    # -----------------------------
+
+    def mint(self, func, params):
+        key = self.key(func, params)
+        with self.lock:
+            if key in self.lru:
+                self.hits += 1
+                value = self.lru.pop(key)
+                self.lru[key] = value
+                return value
+            if self.conn is not None:
+                row = self.conn.execute('SELECT value FROM mints WHERE key=?', (key,)).fetchone()
+                if row is not None:
+                    self.hits += 1
+                    self.remember(key, row[0])
+                    return row[0]
+            self.misses += 1
+
+        value = func(params)
+
+        with self.lock:
+            self.remember(key, value)
+            if self.conn is not None:
+                # Committed right away, so an interrupted run keeps every mint it paid for
+                self.conn.execute('INSERT OR REPLACE INTO mints VALUES (?, ?)', (key, value))
+                self.conn.commit()
+        return value
+
+    def remember(self, key, value):
+        self.lru[key] = value
+        while len(self.lru) > self.max_size:
+            self.lru.popitem(last=False)
+
+    @staticmethod
+    def key(func, params):
+        s = func.__name__ + json.dumps(params, sort_keys=True)
+        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+# Shared by all Polynyms
+mint_cache = MintCache()
+
+
+def test_mint_cache():
+
+    logger = logging.getLogger(test_mint_cache.__name__)
+
+    fn = 'mint_cache_tmp.sqlite'
+    if os.path.exists(fn):
+        os.remove(fn)
+
+    cache = MintCache(max_size=2)
+    cache.open_store(fn)
+
+    gid = cache.get_gid({'pname': 'Merck PhD^Derek'})
+    assert cache.get_gid({'pname': 'Merck PhD^Derek'}) == gid
+    assert cache.get_pname_for_gid({'gid': gid}) == 'Fortinbras^Quickly^S^King^IV'
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # Mints are visible to other connections without waiting for exit
+    other = sqlite3.connect(fn)
+    assert other.execute('SELECT COUNT(*) FROM mints').fetchone()[0] == 2
+    other.close()
+
+    # Falls out of memory, but is still in the store
+    cache.get_gid({'accession_number': '12345678'})
+    cache.clear()
+    assert cache.get_gid({'pname': 'Merck PhD^Derek'}) == gid
+    assert (cache.hits, cache.misses) == (1, 0)
+    logger.debug(cache.lru)
+
+    cache.conn.close()
+    os.remove(fn)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    test_mint_cache()
@@ -2,14 +2,82 @@
 
 import logging
 import os
-from Interface import Interface
-from Polynym import DicomSeries, DicomStudy, DicomSubject
+import io
+import time
+import tempfile
+import zipfile
+from multiprocessing.pool import ThreadPool
+from Interface import Interface, relayed
+from Polynym import DicomSeries, DicomStudy, DicomSubject, pseudonymize
+
+
+class OrthancJob(object):
+    # Handle on an asynchronous Orthanc job, such as a retrieve or a store.  The job
+    # state is polled with exponential backoff, and once it succeeds the result is
+    # resolved by calling on_success (or is the final job info if there isn't one).
+
+    def __init__(self, interface, response, on_success=None):
+        self.interface = interface
+        self.on_success = on_success
+        self.info = {}
+        # Servers without a jobs engine run the request synchronously and don't return an ID
+        if isinstance(response, dict) and response.get('ID'):
+            self.job_id = response.get('ID')
+            self.state = 'Pending'
+        else:
+            self.job_id = None
+            self.state = 'Success'
+            self.info = response
+        self._result = None
+        self._resolved = False
+
+    def __repr__(self):
+        return 'OrthancJob(%s, %s)' % (self.job_id, self.state)
+
+    def poll(self):
+        if not self.done():
+            self.info = self.interface.do_get('jobs', self.job_id)
+            self.state = self.info.get('State', 'Failure')
+        return self.state
+
+    def done(self):
+        return self.state in ('Success', 'Failure')
+
+    def wait(self, timeout=None, interval=0.5, max_interval=10):
+        start = time.time()
+        while self.poll() not in ('Success', 'Failure'):
+            if timeout is not None and time.time() - start > timeout:
+                raise IOError('Timed out waiting for Orthanc job %s' % self.job_id)
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+        return self.result()
+
+    def result(self):
+        if self.state == 'Failure':
+            raise IOError('Orthanc job %s failed: %s' % (self.job_id, self.info.get('ErrorDescription')))
+        if not self._resolved:
+            self._result = self.on_success() if self.on_success else self.info
+            self._resolved = True
+        return self._result
 
 
 class OrthancInterface(Interface):
 
+    # Number of resources requested per page for expanded listings
+    page_size = 1000
+
+    # Ask Orthanc to include PatientIdentityRemoved with resource info (Orthanc >= 1.11)
+    requested_tags = {'requestedTags': '0012,0062'}
+
     def __init__(self, **kwargs):
         super(OrthancInterface, self).__init__(**kwargs)
+        self.page_size = kwargs.get('page_size', self.page_size)
+
+        # 'archive' has the server build the zip, 'instances' fetches instances in parallel
+        self.download_engine = kwargs.get('download_engine', 'archive')
+
+        # Cache of PatientIdentityRemoved status by (level, resource_id)
+        self.anonymization_status = {}
 
     # Derived Class Implementations
     def series_from_id(self, series_id):
@@ -17,14 +85,47 @@ class OrthancInterface(Interface):
         if self.series.get(series_id):
             return self.series.get(series_id)
 
-        # Assemble the study data
-        series_info = self.do_get('series', series_id)
-        series_tags = self.do_get('series', series_id, 'shared-tags')
+        # Check if it's in the catalog
+        series = self.from_catalog('series', series_id)
+        if series is not None:
+            return series
 
-        if series_tags.get('0012,0062').get('Value') == "YES":
-            anonymized = True
-        else:
-            anonymized = False
+        series_info = self.do_get('series', series_id, params=self.requested_tags)
+        return self.series_from_info(series_info)
+
+    def study_from_id(self, study_id):
+        # Check if study is already in interface
+        if self.studies.get(study_id):
+            return self.studies.get(study_id)
+
+        # Check if it's in the catalog
+        study = self.from_catalog('study', study_id)
+        if study is not None:
+            return study
+
+        study_info = self.do_get('studies', study_id, params=self.requested_tags)
+        return self.study_from_info(study_info)
+
+    def subject_from_id(self, subject_id):
+        # Check if study is already in interface
+        if self.subjects.get(subject_id):
+            return self.subjects.get(subject_id)
+
+        # Check if it's in the catalog
+        subject = self.from_catalog('subject', subject_id)
+        if subject is not None:
+            return subject
+
+        subject_info = self.do_get('patients', subject_id, params=self.requested_tags)
+        return self.subject_from_info(subject_info)
+
+    # Factories from resource info, as returned by 'series/<id>' or an expanded listing
+    def series_from_info(self, series_info):
+        series_id = series_info['ID']
+        if self.series.get(series_id):
+            return self.series.get(series_id)
+
+        anonymized = self.is_anonymized('series', series_id, series_info)
 
         # Get study
         study = self.study_from_id(series_info['ParentStudy'])
@@ -37,67 +138,154 @@ class OrthancInterface(Interface):
 
         # Add series to the interface
         self.series[series_id] = series
+        if self.catalog is not None:
+            self.catalog.add(series)
         return series
 
-    def study_from_id(self, study_id):
-        # Check if study is already in interface
+    def study_from_info(self, study_info):
+        study_id = study_info['ID']
         if self.studies.get(study_id):
             return self.studies.get(study_id)
 
-        # Assemble the study data
-        study_info = self.do_get('studies', study_id)
-        study_tags = self.do_get('studies', study_id, 'shared-tags')
-
-        if study_tags.get('0012,0062',{}).get('Value') == "YES":
-            anonymized = True
-        else:
-            anonymized = False
-
-        # self.logger.info('Tags: %s' % study_tags['0012,0062']['Value'])
+        anonymized = self.is_anonymized('studies', study_id, study_info)
 
         # Get subject
         subject = self.subject_from_id(study_info['ParentPatient'])
 
         # Assemble the study data
-        study = DicomStudy(study_id=study_info['MainDicomTags'].get('AccessionNumber', 'No ID'),
-                           anonymized=anonymized,
-                           subject=subject)
+        tags = study_info['MainDicomTags']
+        kwargs = {'study_id': tags.get('AccessionNumber', 'No ID'),
+                  'study_uid': tags.get('StudyInstanceUID'),
+                  'anonymized': anonymized,
+                  'subject': subject}
+        if tags.get('AccessionNumber'):
+            kwargs['accession_number'] = tags['AccessionNumber']
+        study = DicomStudy(**kwargs)
         study['study_id', self] = study_id
 
         self.studies[study_id] = study
+        if self.catalog is not None:
+            self.catalog.add(study)
         return study
 
-    def subject_from_id(self, subject_id):
-        # Check if study is already in interface
+    def subject_from_info(self, subject_info):
+        subject_id = subject_info['ID']
         if self.subjects.get(subject_id):
             return self.subjects.get(subject_id)
 
-        # Assemble the subject data
-        subject_info = self.do_get('patients', subject_id)
-        subject_tags = self.do_get('patients', subject_id, 'shared-tags')
-
         # Check deidentification status
-        if subject_tags.get('0012,0062',{}).get('Value') == "YES":
-            anonymized = True
-        else:
-            anonymized = False
+        anonymized = self.is_anonymized('patients', subject_id, subject_info)
 
         subject = DicomSubject(subject_id=subject_info['MainDicomTags'].get('PatientID', 'No ID'),
                                subject_name=subject_info['MainDicomTags'].get('PatientName', 'No Name'),
-                               subject_dob=subject_info['MainDicomTags'].get('PatientBirthDate', 'No Date'),
+                               dob=subject_info['MainDicomTags'].get('PatientBirthDate'),
                                anonymized=anonymized)
         subject['subject_id', self] = subject_id
 
         # Add subject to the interface
         self.subjects[subject_id] = subject
+        if self.catalog is not None:
+            self.catalog.add(subject)
         return subject
 
-    def find(self, level, query, source=None):
-        if isinstance(source, Interface):
-            source_name = source.name
-        else:
-            source_name = source
-
+    def is_anonymized(self, level, resource_id, info=None):
+        # Checks PatientIdentityRemoved (0012,0062), trying the cheapest source first:
+        # requested tags in the resource info, then the single tag from one instance,
+        # and only then the full shared-tags document
+        if (level, resource_id) in self.anonymization_status:
+            return self.anonymization_status[(level, resource_id)]
+
+        value = None
+        requested_tags = (info or {}).get('RequestedTags')
+        if requested_tags is not None:
+            value = requested_tags.get('PatientIdentityRemoved', requested_tags.get('0012,0062', ''))
+
+        if value is None:
+            instance_id = self.first_instance(level, resource_id, info)
+            if instance_id and ('instances', instance_id) in self.anonymization_status:
+                value = "YES" if self.anonymization_status[('instances', instance_id)] else ''
+            elif instance_id:
+                value = self.probe_tag(instance_id, '0012-0062')
+                if value is not None:
+                    self.anonymization_status[('instances', instance_id)] = value == "YES"
+
+        if value is None:
+            self.logger.debug('Falling back to shared-tags for %s %s', level, resource_id)
+            tags = self.do_get(level, resource_id, 'shared-tags')
+            value = tags.get('0012,0062', {}).get('Value')
+
+        anonymized = value == "YES"
+        self.anonymization_status[(level, resource_id)] = anonymized
+        return anonymized
+
+    def first_instance(self, level, resource_id, info=None):
+        # Walks down the hierarchy to any one instance of a patient, study, or series
+        children = {'patients': ('Studies', 'studies'),
+                    'studies': ('Series', 'series'),
+                    'series': ('Instances', None)}
+        while True:
+            if not info:
+                info = self.do_get(level, resource_id)
+            if not isinstance(info, dict):
+                return None
+            key, child_level = children[level]
+            child_ids = info.get(key)
+            if not child_ids:
+                return None
+            if child_level is None:
+                return child_ids[0]
+            level, resource_id, info = child_level, child_ids[0], None
+
+    def probe_tag(self, instance_id, tag):
+        # Fetches the raw value of a single tag from an instance, '' if the tag is not
+        # present, or None if the server couldn't answer
+        url = self.session.format_url('instances', instance_id, 'content', tag)
+        r = self.session.get(url)
+        if r.status_code == 404:
+            return ''
+        elif r.status_code != 200:
+            return None
+        return r.content.strip(' \x00')
+
+    def iter_resources(self, level):
+        # Pages through an expanded 'patients', 'studies' or 'series' listing, yielding
+        # the info dict for each resource, so the index can be built in a few requests
+        params = dict(self.requested_tags, expand='', limit=self.page_size)
+
+        def get_page(since):
+            params['since'] = since
+            return self.do_get(level, params=params)
+
+        return self.iter_pages(level, get_page)
+
+    def iter_pages(self, level, get_page):
+        # Calls get_page(since) until the results run out, yielding resource info dicts
+        since = 0
+        first_id = None
+        while True:
+            page = get_page(since)
+            if not page or not isinstance(page, list):
+                break
+
+            # Servers that ignore 'limit'/'since' return the entire listing every time
+            page_id = page[0] if isinstance(page[0], basestring) else page[0]['ID']
+            if page_id == first_id:
+                break
+            first_id = first_id or page_id
+
+            for info in page:
+                if isinstance(info, basestring):
+                    # Server predates 'expand', so fall back to one lookup per resource
+                    info = self.do_get(level, info, params=self.requested_tags)
+                yield info
+
+            if len(page) != self.page_size:
+                break
+            since += len(page)
+
+    def find(self, level, query, source=None, lazy=False):
+        # Returns a worklist of all matching items; with lazy=True returns a generator
+        # instead, which fetches matches a page at a time and builds items as they're reached
         if level.lower() == 'subject' or level.lower() == 'patient':
             level_name = 'Patient'
         elif level.lower() == 'study':
@@ -109,48 +297,99 @@ class OrthancInterface(Interface):
             level_name = None
 
         data = {'Level': level_name, 'Query': query}
-        worklist = []
 
         if source:
-            # Checking a different modality
-            resp_id = self.do_post('modalities', source_name, 'query', data=data).get('ID')
-
-            answers = self.do_get('queries', resp_id, 'answers')
-            for a in answers:
-                # Add to available studies, flag as present on source
-                item_data = self.do_get('queries', resp_id, 'answers', a, 'content?simplify')
-                item = None
-                if level == 'subject':
-                    item = DicomSubject(subject_id=item_data.get('PatientID'),
-                                        subject_name=item_data.get('PatientName'))
-                    item['subject_id', source] = (resp_id, a)
-                if level == 'study':
-                    subject = DicomSubject(subject_id=item_data.get('PatientID'),
-                                           subject_name=item_data.get('PatientName'))
-                    item = DicomStudy(study_id=item_data['AccessionNumber'], subject=subject)
-                    item['study_id', source] = (resp_id, a)
-                elif level == 'series':
-                    subject = DicomSubject(subject_id=item_data.get('PatientID'),
-                                           subject_name=item_data.get('PatientName'))
-                    study = DicomStudy(accession_number=item_data['AccessionNumber'], subject=subject)
-                    item = DicomSeries(series_id=item_data['SeriesInstanceUID'], study=study)
-                    item['series_id', source] = (resp_id, a)
-                    # item.study = study
-                worklist.append(item)
+            worklist = self.iter_remote_find(level, data, source)
+        else:
+            worklist = self.iter_local_find(level_name, data)
+
+        if lazy:
+            return worklist
+        return list(worklist)
+
+    def iter_remote_find(self, level, data, source):
+        # Yields items as answers to a C-FIND on a remote modality are retrieved.  Answers
+        # are fetched in one expanded request if the server supports it, otherwise their
+        # contents are fetched concurrently on a pool bounded by max_connections
+        if isinstance(source, Interface):
+            source_name = source.name
         else:
-            # Add to available studies
-            item = None
-            item_data = self.do_post('tools/find', data=data)
-            self.logger.debug('Local find: %s' % item_data)
-            if level == 'study':
-                item = self.study_from_id(item_data[0])
-                item['study_id', self] = item_data[0]
-            elif level == 'series':
-                item = self.series_from_id(item_data[0])
-                item['series_id', self] = item_data[0]
-            worklist.append(item)
-
-        return worklist
+            source_name = source
+
+        # Ask for the StudyInstanceUID as well, which identifies studies unambiguously
+        if data['Level'] in ('Study', 'Series'):
+            data = dict(data, Query=dict({'StudyInstanceUID': ''}, **data['Query']))
+
+        # Checking a different modality
+        with relayed(source):
+            resp_id = self.do_post('modalities', source_name, 'query', data=data, check=True).get('ID')
+
+        answers = self.do_get('queries', resp_id, 'answers', params={'expand': '', 'simplify': ''})
+        if answers and all(isinstance(a, dict) for a in answers):
+            for a, item_data in enumerate(answers):
+                yield self.item_from_answer(level, item_data, source, resp_id, str(a))
+            return
+
+        def get_answer(a):
+            return a, self.do_get('queries', resp_id, 'answers', a, 'content?simplify')
+
+        pool = ThreadPool(self.max_connections)
+        try:
+            for a, item_data in pool.imap_unordered(get_answer, answers):
+                yield self.item_from_answer(level, item_data, source, resp_id, a)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def item_from_answer(self, level, item_data, source, resp_id, a):
+        # Add to available studies, flag as present on source.  Nodes are interned, so
+        # answers for the same subject or study share one node.
+        item = None
+        if level == 'subject':
+            item = DicomSubject.intern(subject_id=item_data.get('PatientID'),
+                                       subject_name=item_data.get('PatientName'))
+            item['subject_id', source] = (resp_id, a)
+        if level == 'study':
+            subject = DicomSubject.intern(subject_id=item_data.get('PatientID'),
+                                          subject_name=item_data.get('PatientName'))
+            item = DicomStudy.intern(study_id=item_data['AccessionNumber'],
+                                     study_uid=item_data.get('StudyInstanceUID'),
+                                     subject=subject)
+            item['study_id', source] = (resp_id, a)
+        elif level == 'series':
+            subject = DicomSubject.intern(subject_id=item_data.get('PatientID'),
+                                          subject_name=item_data.get('PatientName'))
+            study = DicomStudy.intern(accession_number=item_data['AccessionNumber'],
+                                      study_uid=item_data.get('StudyInstanceUID'),
+                                      subject=subject)
+            item = DicomSeries.intern(series_id=item_data['SeriesInstanceUID'], study=study)
+            item['series_id', source] = (resp_id, a)
+            # item.study = study
+        return item
+
+    def iter_local_find(self, level_name, data):
+        # Pages through 'tools/find' with 'Expand', so each page of matches arrives in one
+        # request and items are built from the returned info
+        resources = {'Patient': ('patients', self.subject_from_info),
+                     'Study':   ('studies', self.study_from_info),
+                     'Series':  ('series', self.series_from_info)}
+        if level_name not in resources:
+            return
+        level, from_info = resources[level_name]
+
+        data = dict(data,
+                    Expand=True,
+                    Limit=self.page_size,
+                    RequestedTags=self.requested_tags['requestedTags'].split(','))
+
+        def get_page(since):
+            data['Since'] = since
+            page = self.do_post('tools/find', data=data)
+            self.logger.debug('Local find returned %s matches' % len(page))
+            return page
+
+        for info in self.iter_pages(level, get_page):
+            yield from_info(info)
 
     def delete(self, worklist):
         if not isinstance(worklist, list):
@@ -170,57 +409,334 @@ class OrthancInterface(Interface):
                 # TODO: Should delete studies and series as well
             else:
                 self.logger.warn('Unknown Dicom item requested for delete')
+                continue
+
+            if self.catalog is not None:
+                level = {DicomStudy: 'study', DicomSeries: 'series', DicomSubject: 'subject'}[type(item)]
+                self.catalog.remove(level, self, item['%s_id' % level, self])
 
-    def send(self, item, target):
-        raise NotImplementedError
+    def send(self, item, target, wait=True):
+        # Pushes an item, or a whole worklist, to an Orthanc peer or a DICOM modality as a
+        # single asynchronous store job.  Returns the OrthancJob once it has finished, or
+        # with wait=False, as soon as it has been submitted so several sends can overlap
+        from DICOMInterface import DICOMInterface
 
-    def retrieve(self, item, source):
-        # Retrieving from DICOM modality or Orthanc peer
+        if isinstance(item, dict):
+            worklist = [item]
+        else:
+            worklist = list(item)
+
+        resources = []
+        for item in worklist:
+            if isinstance(item, DicomStudy):
+                resource_id = item.get(('study_id', self))
+            elif isinstance(item, DicomSeries):
+                resource_id = item.get(('series_id', self))
+            elif isinstance(item, DicomSubject):
+                resource_id = item.get(('subject_id', self))
+            else:
+                self.logger.warn('Unknown item type requested for send')
+                continue
+            if resource_id is None:
+                self.logger.warn('Skipping %s, it is not on %s', item, self.name)
+                continue
+            resources.append(resource_id)
+
+        if not resources:
+            raise IOError('Nothing to send from %s' % self.name)
+
+        if isinstance(target, Interface):
+            target_name = target.name
+        else:
+            target_name = target
+
+        if isinstance(target, OrthancInterface):
+            destination = 'peers'
+        elif isinstance(target, DICOMInterface):
+            destination = 'modalities'
+        elif target_name in self.do_get('peers'):
+            destination = 'peers'
+        else:
+            destination = 'modalities'
+
+        self.logger.debug('Sending %s resources to %s %s', len(resources), destination, target_name)
+        data = {'Resources': resources, 'Synchronous': False}
+        r = self.do_post(destination, target_name, 'store', data=data, check=True)
+        job = OrthancJob(self, r)
+        if wait:
+            job.wait()
+        return job
+
+    def retrieve(self, item, source, wait=True):
+        # Retrieving from DICOM modality or Orthanc peer as an asynchronous C-MOVE job.
+        # Returns a worklist of the retrieved local items, or with wait=False, an
+        # OrthancJob that resolves to that worklist
+        # The retrieved copy is found again by its UID, since an empty or placeholder
+        # accession number would match every local study of the patient
         if isinstance(item, DicomStudy):
-            self.do_post('queries', item.get(('study_id', source))[0],  # id, source = (q,a)
-                         'answers', item.get(('study_id', source))[1],
-                         'retrieve', data=self.aetitle)
+            q, a = item.get(('study_id', source))  # id, source = (q,a)
             self.logger.debug('Study id: %s' % item.study_id)
-            return self.find('study', {'StudyInstanceID': item.study_id, 'PatientID': item.subject.subject_id})
+            level = 'study'
+            query = {'StudyInstanceUID': item.uid}
         elif isinstance(item, DicomSeries):
-            self.do_post('queries', item.get(('series_id', source))[0],
-                         'answers', item.get(('series_id', source))[1],
-                         'retrieve', data=self.aetitle)
+            q, a = item.get(('series_id', source))
             self.logger.debug('Series id: %s' % item.series_id)
-            return self.find('series', {'SeriesInstanceUID': item.series_id, 'PatientID': item.subject.subject_id})
+            level = 'series'
+            query = {'SeriesInstanceUID': item.uid}
         else:
             self.logger.warn('Unknown item type requested for retreive')
-
-    def download_data(self, item):
+            return
+        if not item.uid:
+            raise ValueError('Cannot retrieve %s, it has no UID to find it by afterwards' % item)
+
+        # Only submitting the C-MOVE is relayed; how long the job then runs depends on the
+        # size of the study more than on the source's load
+        data = {'TargetAet': self.aetitle, 'Synchronous': False}
+        with relayed(source):
+            r = self.do_post('queries', q, 'answers', a, 'retrieve', data=data, check=True)
+        job = OrthancJob(self, r, lambda: self.find(level, query))
+        if wait:
+            return job.wait()
+        return job
+
+    def retrieve_many(self, worklist, source, timeout=None):
+        # Submits all the retrieves at once, then waits for them; returns the combined
+        # worklist of retrieved local items
+        jobs = [self.retrieve(item, source, wait=False) for item in worklist]
+        retrieved = []
+        for job in jobs:
+            if job is not None:
+                retrieved.extend(job.wait(timeout) or [])
+        return retrieved
+
+    def download_data(self, item, fn=None):
 
         if isinstance(item, DicomStudy):
-            item.data = self.do_get('studies', item.get(('study_id', self)), 'archive')
+            level, resource_id = 'studies', item.get(('study_id', self))
         elif isinstance(item, DicomSeries):
-            item.data = self.do_get('series', item.get(('series_id', self)), 'archive')
+            level, resource_id = 'series', item.get(('series_id', self))
         else:
-            self.logger.warn('Unknown item type requested for download')
-
-    def upload_data(self, study):
-        # TODO: Implement Orthanc.upload_data
-        raise NotImplementedError
+            raise NotImplementedError('Unknown item type requested for download')
+        if resource_id is None:
+            raise IOError('%s is not on %s' % (item, self.name))
+
+        if self.download_engine == 'instances':
+            item.data = self.download_instances(level, resource_id, fn)
+        elif fn is None:
+            item.data = self.do_get(level, resource_id, 'archive', check=True)
+        else:
+            item.data = self.do_stream(level, resource_id, 'archive', fp=fn, check=True)
+
+    def download_instances(self, level, resource_id, fn=None):
+        # Alternative to the server-side 'archive': fetches each instance file on parallel
+        # streams and assembles the zip locally, which takes the load off of the server CPU.
+        # Each instance is staged in a temp file, then added to the zip as it lands.  The zip
+        # is assembled beside fn and only renamed to it once every instance is in.
+        instances = self.do_get(level, resource_id, 'instances')
+        self.logger.info('Downloading %s instances from %s %s', len(instances), level, resource_id)
+
+        def fetch(instance):
+            f = tempfile.NamedTemporaryFile(prefix='tithonus-', delete=False)
+            f.close()
+            if self.do_stream('instances', instance['ID'], 'file', fp=f.name) is None:
+                os.remove(f.name)
+                raise IOError('Failed to download instance %s' % instance['ID'])
+            return instance, f.name
+
+        if fn is None:
+            sink = io.BytesIO()
+        else:
+            part_fd, sink = tempfile.mkstemp(prefix='.part-', dir=os.path.dirname(os.path.abspath(fn)))
+            os.close(part_fd)
+        zipf = zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+        pool = ThreadPool(self.max_connections)
+        try:
+            for instance, tmp_fn in pool.imap_unordered(fetch, instances):
+                zipf.write(tmp_fn, os.path.join(instance['ParentSeries'], instance['ID'] + '.dcm'))
+                os.remove(tmp_fn)
+            zipf.close()
+        except Exception:
+            zipf.close()
+            if fn is not None:
+                os.remove(sink)
+            raise
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if fn is None:
+            return sink.getvalue()
+        os.rename(sink, fn)
+        return fn
+
+    def upload_data(self, item):
+        # item.data may be a folder, a zip archive path, or an open zip file
+        return self.check_uploaded(self.upload_instances(item.data))
+
+    def upload_archive(self, item, fn):
+        # Instances are posted straight from the folder or archive, so no need to re-zip
+        self.logger.info('Uploading image folder or archive %s', fn)
+        if not os.path.exists(fn):
+            raise IOError('No image folder or archive at %s' % fn)
+        return self.check_uploaded(self.upload_instances(fn))
+
+    def check_uploaded(self, results):
+        # An item only counts as uploaded if every one of its instances was stored
+        failed = [r['file'] for r in results if r['Status'] == 'Failure']
+        if failed or not results:
+            raise IOError('%s of %s instances failed to upload' % (len(failed), len(results)))
+        return results
+
+    def upload_instances(self, source):
+        # Posts every file in a folder or zip archive to 'instances' on a pool bounded by
+        # max_connections.  Files are streamed from disk and archive members are read
+        # one at a time, so memory use is bounded by the largest single instance.
+        # Returns a list of {'file', 'ID', 'Status'} results, one per instance.
+        workers = self.max_connections
+        if isinstance(source, basestring) and os.path.isdir(source):
+            names = [os.path.join(dirpath, f) for dirpath, dirnames, filenames in os.walk(source)
+                     for f in filenames]
+
+            def read_instance(name):
+                return open(name, 'rb')
+        else:
+            zipf = zipfile.ZipFile(source)
+            names = [name for name in zipf.namelist() if not name.endswith('/')]
+            if not isinstance(source, basestring):
+                # Members of an already open archive share one file handle
+                workers = 1
+
+            def read_instance(name):
+                return zipf.read(name)
+
+        def post(name):
+            data = read_instance(name)
+            try:
+                r = self.do_post('instances', data=data)
+            finally:
+                if hasattr(data, 'close'):
+                    data.close()
+            if isinstance(r, dict):
+                return {'file': name, 'ID': r.get('ID'), 'Status': r.get('Status')}
+            return {'file': name, 'ID': None, 'Status': 'Failure'}
+
+        self.logger.info('Uploading %s instances', len(names))
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(post, names)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = len([r for r in results if r['Status'] == 'Failure'])
+        if failed:
+            self.logger.warn('%s of %s instances failed to upload', failed, len(results))
+        return results
 
     def all_studies(self):
-        # Reset study index
+        # Reset study index, subjects are bulk-loaded first so parents are already indexed
+        self.all_subjects()
         self.studies = {}
-        study_ids = self.do_get('studies')
-        for study_id in study_ids:
-            self.study_from_id(study_id)
+        for study_info in self.iter_resources('studies'):
+            self.study_from_info(study_info)
 
     def all_subjects(self):
         # Reset subjects index
         self.subjects = {}
-        subject_ids = self.do_get('patients')
-        for subject_id in subject_ids:
-            self.subject_from_id(subject_id)
-
-    # Orthanc ONLY functions
-
-    def anonymize(self, study):
+        for subject_info in self.iter_resources('patients'):
+            self.subject_from_info(subject_info)
+
+    def all_series(self):
+        # Reset series index
+        self.all_studies()
+        self.series = {}
+        for series_info in self.iter_resources('series'):
+            self.series_from_info(series_info)
+
+    def present_ids(self, level):
+        # Identifiers of everything stored (see item_ids), from the expanded listings
+        resource_level = {'subject': 'patients', 'study': 'studies', 'series': 'series'}[level]
+        ids = set()
+        for info in self.iter_resources(resource_level):
+            tags = info['MainDicomTags']
+            if level == 'subject':
+                ids.add(('subject', tags.get('PatientID')))
+            elif level == 'study':
+                ids.add(('uid', tags.get('StudyInstanceUID')))
+                ids.add(('study', info.get('PatientMainDicomTags', {}).get('PatientID'), tags.get('AccessionNumber')))
+            else:
+                ids.add(('uid', tags.get('SeriesInstanceUID')))
+        return ids
+
+    def changes(self, since=0, level='study', limit=None):
+        # Reads one page of the changes feed after sequence number 'since', and returns
+        # the items that have become stable at this level, the last sequence number read,
+        # and whether the feed is exhausted
+        change_types = {'subject': ('StablePatient', self.subject_from_id),
+                        'study':   ('StableStudy', self.study_from_id),
+                        'series':  ('StableSeries', self.series_from_id)}
+        change_type, from_id = change_types[level]
+
+        r = self.do_get('changes', params={'since': since, 'limit': limit or self.page_size})
+        worklist = []
+        for change in r.get('Changes', []):
+            if change.get('ChangeType') != change_type:
+                continue
+            try:
+                worklist.append(from_id(change['ID']))
+            except (KeyError, TypeError, AttributeError):
+                # Resource was removed after the change was logged
+                self.logger.warn('Skipping missing %s %s', level, change['ID'])
+
+        return worklist, r.get('Last', since), r.get('Done', True)
+
+    def refresh_catalog(self):
+        # Brings the catalog up to date with the changes feed since the last refresh.  The
+        # first refresh bulk-loads the whole index, starting from the current last change.
+        if self.catalog is None:
+            self.logger.warn('No catalog configured')
+            return
+
+        state_name = 'changes:%s' % self.name
+        since = self.catalog.get_state(state_name)
+        if since is None:
+            since = self.do_get('changes', params={'last': ''}).get('Last', 0)
+            self.all_series()
+            self.catalog.set_state(state_name, since)
+
+        levels = {'Patient': ('subject', self.subjects, self.subject_from_id),
+                  'Study':   ('study', self.studies, self.study_from_id),
+                  'Series':  ('series', self.series, self.series_from_id)}
+
+        since = int(since)
+        while True:
+            r = self.do_get('changes', params={'since': since, 'limit': self.page_size})
+            for change in r.get('Changes', []):
+                if change.get('ResourceType') not in levels:
+                    continue
+                level, index, from_id = levels[change['ResourceType']]
+                if change['ChangeType'] == 'Deleted':
+                    self.catalog.remove(level, self, change['ID'])
+                    index.pop(change['ID'], None)
+                elif change['ChangeType'].startswith('Stable'):
+                    try:
+                        from_id(change['ID'])
+                    except (KeyError, TypeError, AttributeError):
+                        self.logger.warn('Skipping missing %s %s', level, change['ID'])
+            since = r.get('Last', since)
+            self.catalog.set_state(state_name, since)
+            if r.get('Done', True):
+                break
+
+        # Orthanc ONLY functions
+
+    def anonymization_script(self, study):
+        # Orthanc anonymization request replacing the subject and study with their pseudonyms.
+        # Raises ValueError if the subject has none; a study without a hashed accession
+        # number is left to Orthanc's default profile, which clears it.
+        if not study.subject.get('hashed_id') or not study.subject.pseudonym:
+            raise ValueError('%s has no pseudonym to anonymize it with' % study.subject)
 
         rule_author = "RIH 3D Lab"
         rule_name = "General DICOM Deidentification Rules"
@@ -228,27 +744,72 @@ class OrthancInterface(Interface):
 
         anon_script = {
             "Replace": {
-                "0010-0010": study.subject.subject_name.a,  # PatientsName
-                "0010-0020": study.subject.subject_id.a,    # PatientID
-                "0010-0030": study.subject.subject_dob.a,   # PatientsBirthDate
-                "0008-0050": study.study_id.a,              # AccessionNumber
-                "0012-0062": "YES",                         # Deidentified
-                "0010-0021": rule_author,                   # Issuer of Patient ID
+                "0010-0010": study.subject.pseudonym,           # PatientsName
+                "0010-0020": study.subject.get('hashed_id'),    # PatientID
+                "0012-0062": "YES",                             # Deidentified
+                "0010-0021": rule_author,                       # Issuer of Patient ID
                 "0012-0063": "{0} {1} {2}".format(rule_author, rule_name, rule_version)  # Deidentification method
                 },
             "Keep": [
-                "0008-0080",                                # InstitutionName
-                "0010-0040",                                # PatientsSex
-                "0010-1010",                                # PatientsAge
+                "0008-0080",                                    # InstitutionName
+                "0010-0040",                                    # PatientsSex
+                "0010-1010",                                    # PatientsAge
                 "StudyDescription",
                 "SeriesDescription"],
             "KeepPrivateTags": None
             }
+        if study.hashed_id:
+            anon_script['Replace']['0008-0050'] = study.hashed_id                  # AccessionNumber
+        if study.subject.get('pseudo_dob'):
+            anon_script['Replace']['0010-0030'] = study.subject.get('pseudo_dob')  # PatientsBirthDate
+
+        return anon_script
 
-        anon_study_id = self.do_post('studies', study.study_id[self], 'anonymize', data=anon_script)['ID']
+    def anonymize(self, study, anon_script=None):
+        if anon_script is None:
+            pseudonymize(study)
+            anon_script = self.anonymization_script(study)
+
+        anon_study_id = self.do_post('studies', study['study_id', self], 'anonymize', data=anon_script)['ID']
         # Can unlink original data
-        study.study_id[self, 'original'] = study.study_id[self]
-        study.study_id[self] = anon_study_id
+        study['study_id', self, 'original'] = study['study_id', self]
+        study['study_id', self] = anon_study_id
+
+    def anonymize_many(self, worklist, max_workers=1):
+        # Mints pseudonyms for every unique subject and study in the worklist and prepares
+        # all the scripts up front, then anonymizes each study once.  Returns a list of
+        # {'item', 'error'} results, one per study.
+        subjects, studies = pseudonymize(worklist)
+        results = []
+        scripts = []
+        for study in studies:
+            if study.anonymized:
+                continue
+            try:
+                scripts.append((study, self.anonymization_script(study)))
+            except ValueError as e:
+                self.logger.error('Failed to anonymize %s: %s', study, e)
+                results.append({'item': study, 'error': e})
+        self.logger.info('Prepared %s anonymization scripts for %s subjects', len(scripts), len(subjects))
+
+        def anonymize_study(args):
+            study, anon_script = args
+            try:
+                self.anonymize(study, anon_script)
+                return {'item': study, 'error': None}
+            except Exception as e:
+                self.logger.error('Failed to anonymize %s: %s', study, e)
+                return {'item': study, 'error': e}
+
+        if max_workers > 1:
+            pool = ThreadPool(max_workers)
+            try:
+                return results + pool.map(anonymize_study, scripts)
+            finally:
+                pool.close()
+                pool.join()
+        return results + [anonymize_study(args) for args in scripts]
+
 
 def test_orthanc_juniper():
 
@@ -282,8 +843,8 @@ def orthanc_tests2():
 
         assert item.subject.subject_id == u'ZA4VSDAUSJQA6'
 
+        # Waits on the C-MOVE job before looking the study up locally
         source.retrieve(item, '3dlab-dev0')
-        # Have to wait for a while for it to show up...
 
     source.all_studies()
 
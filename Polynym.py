@@ -6,11 +6,93 @@
 
 import hashlib
 import logging
-import GID_Mint
+import threading
+import weakref
+from collections import OrderedDict
+from MintCache import mint_cache
+
+
+# Per-interface id keys like ('study_id', interface) are interned, so millions of nodes
+# share one tuple for each instead of holding their own copies
+interned_keys = {}
+
+# Stand-ins that interfaces use for a missing id, which never identify anything
+placeholder_ids = ('', 'No ID')
+
+# Every hierarchy node is registered by its registry_key, so that intern() can hand
+# back the one already in use instead of building a duplicate.  Entries go away with
+# the last reference to their node.
+registry = weakref.WeakValueDictionary()
+registry_lock = threading.RLock()
+
+
+class RuleTable(object):
+    # The context map rules for a kind of Polynym, in dependency order.  Rules are given
+    # as the names of Polynym methods (or as plain functions), so one table can be shared
+    # by every node of a class; a node that adds its own map gets a private copy first.
+
+    __slots__ = ('context_maps', 'rule_depends', 'rule_order', 'rule_inputs', 'shared')
+
+    def __init__(self, maps=(), shared=False):
+        self.context_maps = {}
+        # Extra keys that a target's rule reads besides its source
+        self.rule_depends = {}
+        # Rules as (source, target, rule, inputs), and every key that any rule reads
+        self.rule_order = []
+        self.rule_inputs = frozenset()
+        for m in maps:
+            self.add_map(*m)
+        self.shared = shared
+
+    def copy(self):
+        table = RuleTable()
+        table.context_maps = {source: dict(mapping) for source, mapping in self.context_maps.iteritems()}
+        table.rule_depends = dict(self.rule_depends)
+        table.rule_order = list(self.rule_order)
+        table.rule_inputs = self.rule_inputs
+        return table
+
+    def add_map(self, source, target, rule, depends=None):
+        if self.context_maps.get(source):
+            self.context_maps[source].update({target: rule})
+        else:
+            self.context_maps[source] = {target: rule}
+        if depends:
+            self.rule_depends[target] = list(depends)
+        self.sort_rules()
+
+    def sort_rules(self):
+        # Orders rules so that every key is computed before the rules that read it
+        producers = {}
+        for source, mapping in self.context_maps.iteritems():
+            for target in mapping:
+                producers.setdefault(target, []).append(source)
+
+        depths = {}
+
+        def depth(key, visiting=()):
+            if key not in depths:
+                if key not in producers or key in visiting:
+                    return 0
+                inputs = producers[key] + self.rule_depends.get(key, [])
+                depths[key] = 1 + max(depth(k, visiting + (key,)) for k in inputs)
+            return depths[key]
+
+        rules = [(source, target, rule, frozenset([source] + self.rule_depends.get(target, [])))
+                 for source, mapping in self.context_maps.iteritems()
+                 for target, rule in mapping.iteritems()]
+        self.rule_order = sorted(rules, key=lambda r: depth(r[1]))
+        self.rule_inputs = frozenset(self.context_maps).union(*self.rule_depends.values())
 
 
 class Polynym(dict):
 
+    # Nodes keep no __dict__, and their rules live in shared class-level tables
+    __slots__ = ('rules', '__weakref__')
+
+    rule_table = RuleTable(shared=True)
+    anonymized_rule_table = rule_table
+
     @staticmethod
     def identity_rule(s):
         return s
@@ -21,7 +103,12 @@ class Polynym(dict):
 
     def __init__(self, **kwargs):
         super(Polynym, self).__init__(**kwargs)
-        self.context_maps = {}
+        if self.anonymized:
+            self.rules = self.anonymized_rule_table
+        else:
+            self.rules = self.rule_table
+        if self.rules.rule_order:
+            self.apply_rules()
         # if self['anonymized']:
         #     # Set all mappings to identity
         #     self['override_rule'] = Polynym2.identity_rule
@@ -30,23 +117,45 @@ class Polynym(dict):
     def anonymized(self):
         return self.get('anonymized', False)
 
-    def add_map(self, source, target, rule):
-        if self.context_maps.get(source):
-            self.context_maps[source].update({target: rule})
-        else:
-            self.context_maps[source] = {target: rule}
-        self.apply_rules()
+    @property
+    def identity(self):
+        # Context-free id for recognizing the same item across interfaces and runs
+        return self.get('hashed_id')
 
-    def apply_rules(self):
-        for source, mapping in self.context_maps.iteritems():
-            for target, rule in mapping.iteritems():
+    @property
+    def context_maps(self):
+        return self.rules.context_maps
+
+    def add_map(self, source, target, rule, depends=None):
+        if self.rules.shared:
+            self.rules = self.rules.copy()
+        self.rules.add_map(source, target, rule, depends)
+        self.apply_rules(target=target)
+
+    def apply_rules(self, changed=None, target=None):
+        # Recomputes the rules that read a changed key (or the rules for one target), then
+        # the rules that read whatever those changed, each once and in dependency order.
+        # With neither given, every rule is recomputed.
+        dirty = set(changed or [])
+        for source, _target, rule, inputs in self.rules.rule_order:
+            if (changed is None and target is None) or _target == target or not dirty.isdisjoint(inputs):
                 value = self.get(source)
                 if value:
-                    dict.__setitem__(self, target, rule(value))
+                    if isinstance(rule, basestring):
+                        rule = getattr(self, rule)
+                    new_value = rule(value)
+                    if _target not in self or dict.__getitem__(self, _target) != new_value:
+                        dict.__setitem__(self, _target, new_value)
+                        dirty.add(_target)
 
     def __setitem__(self, key, value):
+        if type(key) is tuple:
+            key = interned_keys.setdefault(key, key)
+        # Only keys that feed a rule, and actually changed, trigger any recomputation
+        changed = key not in self or dict.__getitem__(self, key) != value
         dict.__setitem__(self, key, value)
-        self.apply_rules()
+        if changed and key in self.rules.rule_inputs:
+            self.apply_rules([key])
 
     def __cmp__(self, other):
         # Polynyms are considered equivalent if they share _hashed_id_ (same value and rule)
@@ -58,27 +167,120 @@ class Polynym(dict):
 
 class HierarchicalPolynym(Polynym):
 
+    __slots__ = ('parent', '_children', 'data')
+
+    # Keys that identify a node for interning, in order of preference
+    uid_keys = []
+
+    # Key that per-interface resource ids are stored under, as node[id_key, interface]
+    id_key = None
+
     def __init__(self, **kwargs):
         super(HierarchicalPolynym, self).__init__(**kwargs)
         self.parent = kwargs.get('parent')
-        self.children = kwargs.get('children', [])
+        self._children = None
         self.data = kwargs.get('data')
+        for child in kwargs.get('children', []):
+            self.add_child(child)
+
+    def register(self):
+        # Called once the parent is set, since a node's key may depend on it
+        key = self.registry_key(self, self.parent)
+        if key is not None:
+            with registry_lock:
+                registry.setdefault(key, self)
+
+    @classmethod
+    def intern(cls, **kwargs):
+        # Returns the node already in use for this uid, filling in anything it was
+        # missing from kwargs, or builds a new one.  A node that disagrees with kwargs
+        # about any relevant key is someone else, so it gets a new node too.
+        key = cls.registry_key(kwargs)
+        if key is None:
+            return cls(**kwargs)
+        with registry_lock:
+            node = registry.get(key)
+            if node is None:
+                return cls(**kwargs)
+        for k in cls.relevant_keys:
+            if kwargs.get(k) is not None and node.get(k) is not None and node[k] != kwargs[k]:
+                return cls(**kwargs)
+        for k in cls.relevant_keys:
+            if kwargs.get(k) is not None and k not in node:
+                node[k] = kwargs[k]
+        return node
+
+    @classmethod
+    def registry_key(cls, values, parent=None):
+        # (class, uid, anonymized) from the first uid key that is known, or None
+        for k in cls.uid_keys:
+            if values.get(k) not in placeholder_ids + (None,):
+                return cls, values[k], bool(values.get('anonymized', False))
+
+    @property
+    def uid(self):
+        # The DICOM UID, which identifies the node on any interface, if it is known
+        return None
+
+    def uid_key(self, interface=None):
+        # A key that tells this node apart from every other node: its UID, or failing
+        # that, its resource id on the interface.  None if neither is known.
+        if self.uid:
+            return '%s:%s' % (self.__class__.__name__, self.uid)
+        if interface is not None:
+            resource_id = self.get((self.id_key, interface))
+            if isinstance(resource_id, basestring) and resource_id not in placeholder_ids:
+                return '%s:%s:%s' % (self.__class__.__name__, getattr(interface, 'name', interface), resource_id)
+        return None
+
+    @property
+    def children(self):
+        # Children are only held weakly, so a worklist of series can be released even
+        # though each series keeps its study and subject alive
+        if self._children is None:
+            return []
+        self._children = [ref for ref in self._children if ref() is not None]
+        return [ref() for ref in self._children]
+
+    def add_child(self, child):
+        if self._children is None:
+            self._children = []
+        if not any(ref() is child for ref in self._children):
+            self._children.append(weakref.ref(child))
 
 
 class DicomSeries(HierarchicalPolynym):
 
+    __slots__ = ()
+
     relevant_keys = ['series_id', 'anonymized']
+    uid_keys = ['series_id']
+    id_key = 'series_id'
 
     def __init__(self, **kwargs):
         filtered_kwargs = {k: v for (k, v) in kwargs.iteritems() if k in self.relevant_keys}
         super(DicomSeries, self).__init__(**filtered_kwargs)
-        self.parent = kwargs.get('study', DicomStudy(**kwargs))
-        self.study.children.append(self)
+        if kwargs.get('study') is not None:
+            self.parent = kwargs['study']
+        else:
+            self.parent = DicomStudy.intern(**kwargs)
+        self.study.add_child(self)
+        self.register()
 
     @property
     def series_id(self):
         return self.get('series_id')
 
+    @property
+    def identity(self):
+        return self.series_id
+
+    @property
+    def uid(self):
+        # series_id is the SeriesInstanceUID
+        if self.series_id not in placeholder_ids:
+            return self.series_id
+
     @property
     def study(self):
         return self.parent
@@ -98,23 +300,48 @@ class DicomSeries(HierarchicalPolynym):
 
 class DicomStudy(HierarchicalPolynym):
 
-    relevant_keys = ['study_id', 'accession_number', 'anonymized']
+    __slots__ = ()
+
+    relevant_keys = ['study_id', 'accession_number', 'study_uid', 'anonymized']
+    uid_keys = ['study_uid']
+    id_key = 'study_id'
+
+    rule_table = RuleTable([('accession_number', 'hashed_id', 'hashed_accession_rule')], shared=True)
+    anonymized_rule_table = RuleTable([('accession_number', 'hashed_id', 'identity_rule')], shared=True)
 
     def hashed_accession_rule(self, _id):
-        return GID_Mint.get_gid({'accession_number': _id})
+        return mint_cache.get_gid({'accession_number': _id})
         # return Polynym2.md5_rule(id)
 
     def __init__(self, **kwargs):
         filtered_kwargs = {k: v for (k, v) in kwargs.iteritems() if k in self.relevant_keys}
         super(DicomStudy, self).__init__(**filtered_kwargs)
-
-        if self.anonymized:
-            self.add_map('accession_number', 'hashed_id', Polynym.identity_rule)
+        if kwargs.get('subject') is not None:
+            self.parent = kwargs['subject']
+        else:
+            self.parent = DicomSubject.intern(**kwargs)
+        self.subject.add_child(self)
+        self.register()
+
+    @classmethod
+    def registry_key(cls, values, parent=None):
+        # Accession numbers are only unique to a patient, so without a StudyInstanceUID
+        # a study is keyed by its accession number together with its subject's key
+        key = super(DicomStudy, cls).registry_key(values)
+        if key is not None:
+            return key
+        accession_number = values.get('accession_number') or values.get('study_id')
+        if accession_number in placeholder_ids + (None,):
+            return None
+        if parent is None:
+            parent = values.get('subject')
+        if parent is not None:
+            subject_key = parent.registry_key(parent)
         else:
-            self.add_map('accession_number', 'hashed_id', self.hashed_accession_rule)
-        self.apply_rules()
-        self.parent = kwargs.get('subject', DicomSubject(**kwargs))
-        self.subject.children.append(self)
+            subject_key = DicomSubject.registry_key(values)
+        if subject_key is None:
+            return None
+        return cls, accession_number, bool(values.get('anonymized', False)), subject_key
 
     @property
     def study_id(self):
@@ -132,25 +359,47 @@ class DicomStudy(HierarchicalPolynym):
     def hashed_id(self):
         return self.get('hashed_id')
 
+    @property
+    def identity(self):
+        return self.get('hashed_id') or self.study_id
+
+    @property
+    def uid(self):
+        # The StudyInstanceUID; study_id may only be an accession number or a label
+        if self.get('study_uid') not in placeholder_ids:
+            return self.get('study_uid')
+
 
 class DicomSubject(HierarchicalPolynym):
 
+    __slots__ = ('project_id',)
+
     relevant_keys = ['subject_id', 'subject_name', 'dob', 'project_id', 'anonymized']
+    # Names are shared by different patients, so only an id identifies a subject
+    uid_keys = ['subject_id']
+    id_key = 'subject_id'
+
+    rule_table = RuleTable([('subject_name', 'hashed_id',  'hashed_subject_id_rule'),
+                            ('hashed_id',    'pseudonym',  'pseudo_subject_name_rule'),
+                            ('dob',          'pseudo_dob', 'pseudo_subject_dob_rule', ['hashed_id'])], shared=True)
+    anonymized_rule_table = RuleTable([('subject_name', 'pseudonym',  'identity_rule'),
+                                       ('subject_id',   'hashed_id',  'identity_rule'),
+                                       ('dob',          'pseudo_dob', 'identity_rule')], shared=True)
 
     def hashed_subject_id_rule(self, subject_name):
-        return GID_Mint.get_gid({'pname': subject_name})
+        return mint_cache.get_gid({'pname': subject_name})
 
     def pseudo_subject_name_rule(self, dummy):
         # Requires hashed_id is already set
         if not self.get('hashed_id'):
             self['hashed_id'] = self.hashed_subject_id_rule(self['subject_name'])
-        return GID_Mint.get_pname_for_gid({'gid': self['hashed_id']})
+        return mint_cache.get_pname_for_gid({'gid': self['hashed_id']})
 
     def pseudo_subject_dob_rule(self, dob):
         # Requires hashed_id is already set
         if not self.get('hashed_id'):
             self['hashed_id'] = self.hashed_subject_id_rule(self['subject_name'])
-        return GID_Mint.get_pdob_for_dob_and_gid({'gid': self['hashed_id'], 'dob': dob})
+        return mint_cache.get_pdob_for_dob_and_gid({'gid': self['hashed_id'], 'dob': dob})
 
     def __init__(self, **kwargs):
         filtered_kwargs = {k: v for (k, v) in kwargs.iteritems() if k in self.relevant_keys}
@@ -159,16 +408,14 @@ class DicomSubject(HierarchicalPolynym):
         # XNAT subjects are associated with research projects
         # (and diferent projects may have different anonymization rules)
         self.project_id = kwargs.get('project_id', 'root')
+        self.register()
 
-        if self.anonymized:
-            self.add_map('subject_name', 'pseudonym',  Polynym.identity_rule)
-            self.add_map('subject_id',   'hashed_id',  Polynym.identity_rule)
-            self.add_map('dob',          'pseudo_dob', Polynym.identity_rule)
-        else:
-            self.add_map('subject_name', 'hashed_id',  self.hashed_subject_id_rule)
-            self.add_map('hashed_id',    'pseudonym',  self.pseudo_subject_name_rule)
-            self.add_map('dob',          'pseudo_dob', self.pseudo_subject_dob_rule)
-        self.apply_rules()
+    @classmethod
+    def registry_key(cls, values, parent=None):
+        # The same id may be a different subject in another project
+        key = super(DicomSubject, cls).registry_key(values)
+        if key is not None:
+            return key + (values.get('project_id') or 'root',)
 
     @property
     def subject_id(self):
@@ -178,6 +425,38 @@ class DicomSubject(HierarchicalPolynym):
     def pseudonym(self):
         return self.get('pseudonym')
 
+    @property
+    def identity(self):
+        return self.get('hashed_id') or self.subject_id
+
+
+def pseudonymize(worklist):
+    # Returns the unique subjects and studies behind a worklist (or any iterable of nodes)
+    # as (subjects, studies), with studies that only carry their accession number as their
+    # study_id given a hashed_id too.  Nodes mint as their keys are set, and the mint cache
+    # keeps repeated names and accession numbers from being minted more than once.
+    if isinstance(worklist, Polynym):
+        worklist = [worklist]
+
+    subjects = OrderedDict()
+    studies = OrderedDict()
+    for item in worklist:
+        if isinstance(item, DicomSeries):
+            item = item.study
+        if isinstance(item, DicomStudy):
+            studies.setdefault(id(item), item)
+            item = item.subject
+        if isinstance(item, DicomSubject):
+            subjects.setdefault(id(item), item)
+
+    for study in studies.itervalues():
+        if study.anonymized or study.get('accession_number'):
+            continue
+        if study.study_id not in placeholder_ids + (None,):
+            study['accession_number'] = study.study_id
+
+    return subjects.values(), studies.values()
+
 
 def test_polynym2():
 
@@ -226,9 +505,94 @@ def test_dicom_nodes():
     assert(v.subject.children[0].children[0].series_id == 'XYZ')
 
 
+def test_rule_recomputation():
+
+    logger = logging.getLogger('Polynym/rules')
+
+    calls = []
+
+    def counted_rule(s):
+        calls.append(s)
+        return s.lower()
+
+    p = Polynym()
+    p.add_map('a', 'b', counted_rule)
+    p.add_map('b', 'c', counted_rule)
+
+    # Each rule downstream of a change runs once
+    p['a'] = 'VALUE'
+    assert(calls == ['VALUE', 'value'])
+    assert(p['c'] == 'value')
+
+    # Setting the same value, or a key no rule reads, recomputes nothing
+    p['a'] = 'VALUE'
+    p['other'] = 'X'
+    assert(len(calls) == 2)
+
+    logger.debug(p)
+
+
+def test_interning():
+
+    logger = logging.getLogger('Polynym/intern')
+
+    a = DicomSubject.intern(subject_id='ZA4VSDAUSJQA6', anonymized=True)
+    b = DicomSubject.intern(subject_id='PWJ7LZ3QJ4CL6', anonymized=True)
+    assert(DicomSubject.intern(subject_id='ZA4VSDAUSJQA6', anonymized=True) is a)
+
+    # The same accession number only means the same study for the same subject
+    study_a = DicomStudy.intern(study_id='554XZAIY6AW7W', subject=a, anonymized=True)
+    study_b = DicomStudy.intern(study_id='554XZAIY6AW7W', subject=b, anonymized=True)
+    assert(study_a is not study_b)
+    assert(study_b.subject is b)
+    assert(DicomStudy.intern(study_id='554XZAIY6AW7W', subject=a, anonymized=True) is study_a)
+    assert(DicomStudy.intern(study_id='554XZAIY6AW7W', subject_id='ZA4VSDAUSJQA6', anonymized=True) is study_a)
+
+    # A StudyInstanceUID identifies the study on its own, placeholders never do
+    study_c = DicomStudy.intern(study_id='No ID', study_uid='1.2.3', subject=a, anonymized=True)
+    assert(DicomStudy.intern(study_uid='1.2.3', anonymized=True) is study_c)
+    assert(DicomStudy.intern(study_id='No ID', subject=a, anonymized=True) is not
+           DicomStudy.intern(study_id='No ID', subject=a, anonymized=True))
+
+    # Subjects are only the same within a project, never by name alone, and never
+    # when they disagree
+    c = DicomSubject.intern(subject_id='ZA4VSDAUSJQA6', project_id='projB', anonymized=True)
+    assert(c is not a and c.project_id == 'projB')
+    study_d = DicomStudy(study_id='S2', subject_id='ZA4VSDAUSJQA6', project_id='projB', anonymized=True)
+    assert(study_d.subject is c)
+    d = DicomSubject.intern(subject_name='Smith^John', dob='19700101', anonymized=True)
+    e = DicomSubject.intern(subject_name='Smith^John', dob='19800101', anonymized=True)
+    assert(d is not e and e['dob'] == '19800101')
+    f = DicomSubject.intern(subject_id='ZA4VSDAUSJQA6', dob='19700101', anonymized=True)
+    assert(f is a and a['dob'] == '19700101')
+    assert(DicomSubject.intern(subject_id='ZA4VSDAUSJQA6', dob='19800101', anonymized=True) is not a)
+
+    logger.debug(study_a)
+
+
+def test_weak_children():
+
+    import gc
+
+    subject = DicomSubject(subject_id='ZA4VSDAUSJQA6', anonymized=True)
+    study = DicomStudy(study_id='554XZAIY6AW7W', subject=subject, anonymized=True)
+    series = DicomSeries(series_id='1.2.3.4', study=study, anonymized=True)
+    assert(subject.children == [study])
+    assert(study.children == [series])
+
+    # Children go away with the worklist that held them, and leave the registry too
+    del study, series
+    gc.collect()
+    assert(subject.children == [])
+    assert(DicomSeries.registry_key({'series_id': '1.2.3.4', 'anonymized': True}) not in registry)
+
+
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
 
     test_polynym2()
     test_dicom_nodes()
+    test_rule_recomputation()
+    test_interning()
+    test_weak_children()
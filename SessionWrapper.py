@@ -5,7 +5,10 @@ from posixpath import join as urljoin
 from urlparse import urlparse
 import pickle
 import os
+import time
+import tempfile
 from bs4 import BeautifulSoup
+from Throttle import TokenBucket
 
 
 def load_pickle(f, default=None):
@@ -21,6 +24,16 @@ def save_pickle(f, data):
 
 class SessionWrapper(requests.Session):
 
+    # Default block size for streamed transfers
+    chunk_size = 1024 * 1024
+
+    # Times to retry a request the server turned away with 429/503
+    retries = 3
+
+    # Request bodies larger than this (or streamed from a file) are bulk uploads, whose
+    # time says more about their size than about the server's load
+    bulk_body_size = 64 * 1024
+
     cookie_jars_pickle = 'tmp_session_cookies.p'
     cookie_jars = load_pickle(cookie_jars_pickle, {})
 
@@ -31,6 +44,15 @@ class SessionWrapper(requests.Session):
 
         self.address = kwargs.get('address')
         self.auth = (kwargs.get('user'), kwargs.get('pword'))
+        self.chunk_size = kwargs.get('chunk_size', self.chunk_size)
+        self.retries = kwargs.get('retries', self.retries)
+
+        # Optional cap on requests/sec, and an AdaptiveLimiter to report response times to
+        if kwargs.get('rate_limit'):
+            self.rate_limit = TokenBucket(kwargs.get('rate_limit'))
+        else:
+            self.rate_limit = None
+        self.limiter = None
 
         if self.address:
             self.hostname = urlparse(self.address).hostname
@@ -42,14 +64,45 @@ class SessionWrapper(requests.Session):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.info('Created session wrapper for %s' % self.hostname)
 
+    def request(self, method, url, *args, **kwargs):
+        # Every request goes through the rate limit, and its status and time to response
+        # headers are fed back to the limiter (only its status, for a bulk upload).
+        # Overloaded responses are retried after a backoff, unless the body was a stream
+        # that has already been consumed.
+        data = kwargs.get('data')
+        retries = self.retries if data is None or isinstance(data, (basestring, dict)) else 0
+        bulk = data is not None and not isinstance(data, dict) and \
+            (not isinstance(data, basestring) or len(data) > self.bulk_body_size)
+        backoff = 1
+        while True:
+            if self.rate_limit is not None:
+                self.rate_limit.acquire()
+            r = super(SessionWrapper, self).request(method, url, *args, **kwargs)
+            if self.limiter is not None:
+                self.limiter.observe(0 if bulk else r.elapsed.total_seconds(), r.status_code)
+            if r.status_code not in (429, 503) or retries <= 0:
+                return r
+            retries -= 1
+            try:
+                wait = float(r.headers.get('retry-after', backoff))
+            except ValueError:
+                wait = backoff
+            self.logger.warn('Server returned %s, retrying in %s sec', r.status_code, wait)
+            r.close()
+            time.sleep(wait)
+            backoff *= 2
+
     def format_url(self, *url):
         # Simple join, but can override in derived classes and still use 'do_' macros
         url = urljoin(self.address, *url)
         return url
 
-    def do_return(self, r):
+    def do_return(self, r, check=False):
         # Return dict if possible, but content otherwise (for image data)
         # self.logger.info(r.headers.get('content-type'))
+        # With check, an error response raises IOError instead of being returned
+        if check and not 200 <= r.status_code < 300:
+            raise IOError('REST interface returned error %s: %s' % (r.status_code, r.content[:200]))
         if r.status_code is not 200:
             self.logger.warn('REST interface returned error %s', r.status_code)
             ret = r.content
@@ -76,7 +129,7 @@ class SessionWrapper(requests.Session):
         url = self.format_url(*url)
         self.logger.debug('Deleting url: %s' % url)
         r = self.delete(url, params=params, headers=headers)
-        return self.do_return(r)
+        return self.do_return(r, kwargs.get('check'))
 
     def do_get(self, *url, **kwargs):
         params = kwargs.get('params')
@@ -84,11 +137,56 @@ class SessionWrapper(requests.Session):
         url = self.format_url(*url)
         self.logger.debug('Getting url: %s' % url)
         r = self.get(url, params=params, headers=headers)
-        return self.do_return(r)
+        return self.do_return(r, kwargs.get('check'))
 
-    def do_put(self, *url, **kwargs):
+    def do_stream(self, *url, **kwargs):
+        # Stream a response body into 'fp' (a filename or writable file-like) one chunk
+        # at a time so memory use stays flat regardless of the size of the download.
+        # A file is written beside fp and only renamed to it once the download completes,
+        # so a failed transfer never leaves a partial file at fp.
         params = kwargs.get('params')
         headers = kwargs.get('headers')
+        fp = kwargs.get('fp')
+        url = self.format_url(*url)
+        self.logger.debug('Streaming url: %s' % url)
+        r = self.get(url, params=params, headers=headers, stream=True)
+        if r.status_code != 200:
+            self.logger.warn('REST interface returned error %s', r.status_code)
+            r.close()
+            if kwargs.get('check'):
+                raise IOError('REST interface returned error %s' % r.status_code)
+            return None
+
+        size = 0
+        try:
+            if isinstance(fp, basestring):
+                part_fd, part_fn = tempfile.mkstemp(prefix='.part-', dir=os.path.dirname(os.path.abspath(fp)))
+                f = os.fdopen(part_fd, 'wb')
+            else:
+                part_fn = None
+                f = fp
+            try:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    if chunk:
+                        f.write(chunk)
+                        size += len(chunk)
+            finally:
+                if part_fn is not None:
+                    f.close()
+            if part_fn is not None:
+                os.rename(part_fn, fp)
+                part_fn = None
+        finally:
+            r.close()
+            if part_fn is not None and os.path.exists(part_fn):
+                os.remove(part_fn)
+
+        self.logger.debug('Streamed %s bytes', size)
+        return fp
+
+    def do_put(self, *url, **kwargs):
+        params = kwargs.get('params')
+        headers = kwargs.get('headers') or {}
         data = kwargs.get('data')
         if type(data) is dict:
             headers.update({'content-type': 'application/json'})
@@ -96,11 +194,11 @@ class SessionWrapper(requests.Session):
         url = self.format_url(*url)
         self.logger.debug('Putting url: %s' % url)
         r = self.put(url, params=params, headers=headers, data=data)
-        return self.do_return(r)
+        return self.do_return(r, kwargs.get('check'))
 
     def do_post(self, *url, **kwargs):
         params = kwargs.get('params')
-        headers = kwargs.get('headers')
+        headers = kwargs.get('headers') or {}
         data = kwargs.get('data')
         if type(data) is dict:
             headers.update({'content-type': 'application/json'})
@@ -109,7 +207,7 @@ class SessionWrapper(requests.Session):
         url = self.format_url(*url)
         self.logger.debug('Posting to url: %s w params: %s' % (url, params))
         r = self.post(url, params=params, headers=headers, data=data)
-        return self.do_return(r)
+        return self.do_return(r, kwargs.get('check'))
 
     def disable_verification(self):
         requests.packages.urllib3.disable_warnings()
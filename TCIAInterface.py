@@ -94,12 +94,16 @@ class TCIAInterface(Interface):
 
         return self.do_get(url, params=params)
 
-    def download_data(self, item):
+    def download_data(self, item, fn=None):
         # Only has interface for "series"
         if isinstance(item, DicomSeries):
-            item.data = self.do_get('query/getImage', params={'SeriesInstanceUID': item['series_id', self]})
+            params = {'SeriesInstanceUID': item['series_id', self]}
+            if fn is None:
+                item.data = self.do_get('query/getImage', params=params, check=True)
+            else:
+                item.data = self.do_stream('query/getImage', params=params, fp=fn, check=True)
         else:
-            self.logger.warn('TCIAInterface can only download series items')
+            raise NotImplementedError('TCIAInterface can only download series items')
 
 
 def tcia_tests():
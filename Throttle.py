@@ -0,0 +1,118 @@
+# Throttles for keeping parallel transfers within what a server can sustain
+#
+# TokenBucket caps the request rate to a server.  AdaptiveLimiter is a semaphore for
+# in-flight transfers whose limit adapts AIMD-style: it creeps up while responses are
+# fast and healthy, and is cut back sharply on HTTP 429/503 or slow responses.
+
+import logging
+import threading
+import time
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None):
+        # rate is in requests/sec, burst is the most requests that can go out back to back
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter(object):
+
+    # Responses that mean the server wants us to back off
+    overload_codes = (429, 503)
+
+    def __init__(self, max_limit, min_limit=1, target_latency=None, backoff=0.5):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(max_limit)
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def observe(self, latency, status_code):
+        # Additive increase of about one slot per window of successful responses,
+        # multiplicative decrease (at most once per latency period) on overload
+        with self.cond:
+            overloaded = status_code in self.overload_codes or \
+                (self.target_latency is not None and latency > self.target_latency)
+            if overloaded:
+                now = time.time()
+                if now - self.last_decrease > latency:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.last_decrease = now
+                    self.logger.info('Backing off to %s concurrent transfers', int(self.limit))
+            elif status_code < 400:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+
+def test_throttle():
+
+    logger = logging.getLogger(test_throttle.__name__)
+
+    bucket = TokenBucket(20, burst=1)
+    start = time.time()
+    for i in range(5):
+        bucket.acquire()
+    assert time.time() - start >= 0.19
+
+    limiter = AdaptiveLimiter(8, target_latency=1.0)
+    limiter.observe(0.1, 503)
+    assert int(limiter.limit) == 4
+    # Only one decrease per latency period
+    limiter.observe(0.1, 429)
+    assert int(limiter.limit) == 4
+    time.sleep(0.15)
+    limiter.observe(0.1, 429)
+    assert int(limiter.limit) == 2
+    for i in range(20):
+        limiter.observe(0.1, 200)
+    logger.debug(limiter.limit)
+    assert int(limiter.limit) == 6
+
+    # Slow responses count as overload too
+    limiter = AdaptiveLimiter(8, target_latency=1.0)
+    limiter.observe(2.0, 200)
+    assert int(limiter.limit) == 4
+
+    limiter.acquire()
+    limiter.acquire()
+    assert limiter.in_flight == 2
+    limiter.release()
+    limiter.release()
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    test_throttle()
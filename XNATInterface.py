@@ -49,6 +49,22 @@ class XNATInterface(Interface):
         for result in results:
             DicomStudy(study_id=result['ID'])
 
+    def present_ids(self, level):
+        # Identifiers (see item_ids) of all experiments, by subject and experiment label,
+        # or of all subjects, from a single listing
+        ids = set()
+        if level == 'study':
+            resp = self.do_get('data/experiments', params={'columns': 'ID,label,subject_label'})
+            for result in resp.get('ResultSet').get('Result'):
+                ids.add(('study', result.get('subject_label'), result.get('label')))
+        elif level == 'subject':
+            resp = self.do_get('data/subjects')
+            for result in resp.get('ResultSet').get('Result'):
+                ids.update([('subject', result.get('ID')), ('subject', result.get('label'))])
+        else:
+            raise NotImplementedError
+        return ids
+
     def upload_data(self, item):
         # See <https://wiki.xnat.org/display/XKB/Uploading+Zip+Archives+to+XNAT>
 
@@ -65,9 +81,9 @@ class XNATInterface(Interface):
                 params.update({'session': item.study_id})
 
             headers = {'content-type': 'application/zip'}
-            self.do_post('data/services/import', params=params, headers=headers, data=item.data)
+            self.do_post('data/services/import', params=params, headers=headers, data=item.data, check=True)
         else:
-            self.logger.warn('XNATInterface can only upload study items')
+            raise NotImplementedError('XNATInterface can only upload study items')
 
         # TODO: Need to check for upload errors when a duplicate study is pushed.
 
@@ -96,7 +112,7 @@ class XNATInterface(Interface):
     # XNAT specific
 
     def set_study_attribute(self, study, key):
-        value = study.__dict__[key]
+        value = study.get(key)
         params = {self.var_dict[key]: value}
         self.do_put('data/archive/projects', study.subject.project_id,
                     'subjects', study.subject.subject_id[self],
@@ -19,6 +19,9 @@ See README.md for usage, notes, and license info.
 import logging
 import argparse
 import os
+import signal
+import threading
+import Queue
 import yaml
 
 __package__ = "tithonus"
@@ -31,7 +34,9 @@ __version_info__ = ('0', '2', '3')
 __version__ = '.'.join(__version_info__)
 logger = logging.getLogger('Tithonus CLI')
 
-from Interface import Interface
+from Interface import Interface, target_name
+from Journal import Journal
+from MintCache import mint_cache
 
 
 # Effectively reduces the problem to implementing a generic query, copy, and delete for each interface
@@ -39,31 +44,187 @@ def find(source, query):
     return source.find(query['level'], query['Query'])
 
 
-def copy(source, target, worklist, anonymize=False):
+def copy(source, target, worklist, anonymize=False, max_workers=1, pipeline=False, journal=None, dedup=False):
     if isinstance(source, basestring):
         # It's a local file being uploaded
-        target.copy(worklist, source, target, anonymize)
+        return target.copy(worklist, source, target, anonymize, max_workers, journal)
+
+    if dedup and isinstance(target, Interface):
+        # Skip anything the target already has
+        worklist = source.dedup(worklist, target, journal)
+
+    if isinstance(target, list):
+        # Fan out, downloading each item once and uploading it to every target
+        return source.pipe(worklist, target, max_workers, journal=journal)
+    elif pipeline and isinstance(target, Interface):
+        # Overlap downloads from the source with uploads to the target
+        return source.pipe(worklist, target, max_workers, journal=journal)
     else:
-        source.copy(worklist, source, target, anonymize)
+        return source.copy(worklist, source, target, anonymize, max_workers, journal)
 
 
 def delete(source, worklist):
     source.delete(worklist)
 
 
-def move(source, target, worklist, anonymize=False ):
-    copy(source, target, worklist, anonymize)
-    delete(source, worklist)
+def move(source, target, worklist, anonymize=False, max_workers=1, pipeline=False, journal=None, dedup=False):
+    results = copy(source, target, worklist, anonymize, max_workers, pipeline, journal, dedup)
+    # Only remove items that actually made it to the target
+    copied = [r['item'] for r in results if r['error'] is None]
+    if journal:
+        copied = [item for item in copied if not journal.reached(item, source, target, 'deleted')]
+    delete(source, copied)
+    if journal:
+        for item in copied:
+            journal.set(item, source, target, 'deleted')
+    return results
 
 
-def mirror(source, target, query, anonymize=False):
+def mirror(source, target, query, anonymize=False, max_workers=1, pipeline=False, journal=None, dedup=False):
     worklist = find(source, query)
-    copy(source, target, worklist, anonymize)
+    return copy(source, target, worklist, anonymize, max_workers, pipeline, journal, dedup)
 
 
-def transfer(source, target, query, anonymize=False):
+def transfer(source, target, query, anonymize=False, max_workers=1, pipeline=False, journal=None, dedup=False):
     worklist = find(source, query)
-    move(source, target, worklist, anonymize)
+    return move(source, target, worklist, anonymize, max_workers, pipeline, journal, dedup)
+
+
+def mirror_changes(source, target, state_fn, level='study', anonymize=False, max_workers=1, pipeline=False):
+    # Incremental mirror driven by the source's changes feed.  Only items that have become
+    # stable since the last run are copied, and the last processed sequence number is kept
+    # in state_fn per source/target pair, so an interrupted mirror picks up where it stopped
+    since = read_change_state(state_fn, source, target)
+
+    while True:
+        worklist, last, done = source.changes(since, level)
+        if worklist:
+            logger.info('Mirroring %s new items from changes %s-%s', len(worklist), since, last)
+            results = copy(source, target, worklist, anonymize, max_workers, pipeline)
+            if [r for r in results if r['error'] is not None]:
+                # Leave the sequence number alone so the next run retries this batch
+                logger.error('Stopping incremental mirror at change %s', since)
+                break
+        since = last
+        write_change_state(state_fn, source, target, since)
+        if done:
+            break
+
+    return since
+
+
+def watch(source, target, state_fn, level='study', anonymize=False, max_workers=1, poll_interval=10):
+    # Long-running forwarder.  Interfaces and their sessions stay open while the source's
+    # changes feed is polled, and new items are fed through a bounded queue to a pool of
+    # transfer workers, so polling pauses whenever the workers fall behind.  Progress is
+    # saved after each batch as in mirror_changes.  SIGINT/SIGTERM stop feeding the
+    # workers and let only the in-flight items finish; the interrupted batch isn't marked
+    # done, so it is picked up again on the next start.
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        logger.info('Received signal %s, finishing in-flight transfers', signum)
+        stop.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    pending = Queue.Queue(maxsize=max_workers * 2)
+    failed = []
+
+    def work():
+        while True:
+            item = pending.get()
+            try:
+                if item is None:
+                    break
+                if stop.is_set():
+                    # Queued but not started, leave it for the next start
+                    continue
+                results = copy(source, target, item, anonymize)
+                failed.extend(r['item'] for r in results if r['error'] is not None)
+            finally:
+                pending.task_done()
+
+    workers = [threading.Thread(target=work) for i in range(max_workers)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    since = read_change_state(state_fn, source, target)
+    logger.info('Watching %s from change %s', source.name, since)
+
+    while not stop.is_set():
+        try:
+            worklist, last, done = source.changes(since, level)
+        except Exception as e:
+            logger.error('Failed to poll changes: %s', e)
+            stop.wait(poll_interval)
+            continue
+
+        del failed[:]
+        for item in worklist:
+            # Blocks while the workers are busy, but keeps checking for a stop
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=0.5)
+                    break
+                except Queue.Full:
+                    pass
+            if stop.is_set():
+                break
+
+        # Wait with a timeout, so signals are still handled meanwhile
+        with pending.all_tasks_done:
+            while pending.unfinished_tasks:
+                pending.all_tasks_done.wait(0.5)
+
+        if stop.is_set():
+            break
+
+        if failed:
+            # Retry the batch on the next poll
+            logger.error('%s items failed, retrying changes after %s', len(failed), since)
+            stop.wait(poll_interval)
+            continue
+
+        if worklist:
+            logger.info('Forwarded %s items from changes %s-%s', len(worklist), since, last)
+        since = last
+        write_change_state(state_fn, source, target, since)
+        if done:
+            stop.wait(poll_interval)
+
+    for w in workers:
+        pending.put(None)
+    for w in workers:
+        w.join()
+    logger.info('Stopped watching %s at change %s', source.name, since)
+    return since
+
+
+def change_state_key(source, target):
+    # Fan-out targets share one state entry, named after all of them
+    if isinstance(target, list):
+        name = ','.join(target_name(t) for t in target)
+    else:
+        name = target_name(target)
+    return '%s->%s' % (source.name, name)
+
+
+def read_change_state(state_fn, source, target):
+    state = {}
+    if os.path.isfile(state_fn):
+        state = read_yaml(state_fn) or {}
+    return state.get(change_state_key(source, target), 0)
+
+
+def write_change_state(state_fn, source, target, since):
+    state = {}
+    if os.path.isfile(state_fn):
+        state = read_yaml(state_fn) or {}
+    state[change_state_key(source, target)] = since
+    write_yaml(state_fn, state)
 
 
 def read_yaml(fn):
@@ -73,16 +234,24 @@ def read_yaml(fn):
         return y
 
 
+def write_yaml(fn, data):
+    # Write to a temp file and rename it, so the file is never left half-written
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'w') as f:
+        yaml.safe_dump(data, f, default_flow_style=False)
+    os.rename(tmp_fn, fn)
+
+
 def get_args():
     """Setup args and usage"""
     parser = argparse.ArgumentParser(description='Tithonus Core')
 
     parser.add_argument('command',
-                        choices=['find', 'copy', 'delete', 'move', 'mirror', 'transfer'])
+                        choices=['find', 'copy', 'delete', 'move', 'mirror', 'transfer', 'watch'])
     parser.add_argument('source',
                         help='Source/working image repository as json or ID in config')
     parser.add_argument('target',
-                        help='Target image repository as json or as ID in config')
+                        help='Target image repository as json or as ID in config, or several comma-separated IDs')
     parser.add_argument('-i', '--input',
                         help='Worklist of items to process or query/filter as json, yaml, or csv file')
     parser.add_argument('-o', '--outfile',
@@ -91,6 +260,33 @@ def get_args():
                         help='Anonymize patients and studies before copy/move (if source is orthanc-type)',
                         action='store_true',
                         default='False')
+    parser.add_argument('-w', '--workers',
+                        help='Number of items to transfer concurrently',
+                        type=int,
+                        default=1)
+    parser.add_argument('-p', '--pipeline',
+                        help='Overlap downloads from the source with uploads to the target',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('-n', '--incremental',
+                        help='Mirror only items that changed on the source since the last run',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--state',
+                        help='File for tracking incremental mirror progress',
+                        default='./mirror_state.yaml')
+    parser.add_argument('--poll',
+                        help='Seconds between polls of the source when watching',
+                        type=float,
+                        default=10)
+    parser.add_argument('-j', '--journal',
+                        help='File for recording per-item progress, so an interrupted copy can resume')
+    parser.add_argument('-k', '--skip_present',
+                        help='Skip items that the target already has',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('-m', '--mint_cache',
+                        help='File for keeping pseudonyms between runs, so each subject is only minted once')
     parser.add_argument('-c', '--config',
                         help='Image repository configuration file',
                         default='./repo.yaml')
@@ -154,6 +350,75 @@ def test_dicom_download_dev():
     os.remove('nlst_tmp_archive.zip')
 
 
+def test_mirror_changes():
+
+    import shutil
+    import tempfile
+    from Interface import MemoryInterface
+    from Polynym import DicomStudy
+
+    tmp_dir = tempfile.mkdtemp(prefix='tithonus-')
+    state_fn = os.path.join(tmp_dir, 'state.yaml')
+    source = MemoryInterface(name='source')
+    target = MemoryInterface(name='target')
+    for i in range(5):
+        study = DicomStudy(study_id='A%d' % i, study_uid='1.2.%d' % i, subject_id='P1', anonymized=True)
+        source.hold(study, b'DATA-%d' % i)
+        source.feed.append(study)
+    target.failing.add('1.2.3')
+
+    # Stops before the batch with a failure, and picks up from there next time
+    assert mirror_changes(source, target, state_fn) == 2
+    assert read_change_state(state_fn, source, target) == 2
+    target.failing.clear()
+    assert mirror_changes(source, target, state_fn) == 5
+    assert len(target.archives) == 5
+
+    # Fan-out targets keep their own state
+    fan = [MemoryInterface(name='a'), os.path.join(tmp_dir, 'fan')]
+    assert mirror_changes(source, fan, state_fn) == 5
+    assert read_yaml(state_fn) == {'source->target': 5, 'source->a,%s' % fan[1]: 5}
+    assert len(os.listdir(fan[1])) == 5
+
+    shutil.rmtree(tmp_dir)
+
+
+def test_watch():
+
+    import shutil
+    import tempfile
+    from Interface import MemoryInterface
+    from Polynym import DicomStudy
+
+    tmp_dir = tempfile.mkdtemp(prefix='tithonus-')
+    state_fn = os.path.join(tmp_dir, 'state.yaml')
+    target = MemoryInterface(name='target')
+
+    class Source(MemoryInterface):
+        # Sends itself SIGTERM once the feed has been forwarded
+        def changes(self, since=0, level='study', limit=2):
+            if since >= len(self.feed):
+                os.kill(os.getpid(), signal.SIGTERM)
+            return super(Source, self).changes(since, level, limit)
+
+    source = Source(name='source')
+    for i in range(5):
+        study = DicomStudy(study_id='A%d' % i, study_uid='1.2.%d' % i, subject_id='P1', anonymized=True)
+        source.hold(study, b'DATA-%d' % i)
+        source.feed.append(study)
+
+    handlers = signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)
+    try:
+        assert watch(source, target, state_fn, max_workers=2, poll_interval=0.1) == 5
+    finally:
+        signal.signal(signal.SIGINT, handlers[0])
+        signal.signal(signal.SIGTERM, handlers[1])
+    assert read_change_state(state_fn, source, target) == 5
+    assert len(target.archives) == 5
+
+    shutil.rmtree(tmp_dir)
+
+
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
@@ -176,6 +441,12 @@ if __name__ == "__main__":
     worklist = input
     query = input
     anonymize = args.anonymize
+    max_workers = args.workers
+    pipeline = args.pipeline
+    journal = Journal(args.journal) if args.journal else None
+    dedup = args.skip_present
+    if args.mint_cache:
+        mint_cache.open_store(args.mint_cache)
     output = args.get('output')
 
     source = None
@@ -186,23 +457,31 @@ if __name__ == "__main__":
 
     target = None
     if args.get('target'):
-        target_config = args.config[args.get('target')]
-        target_config['name'] = args.get('target')
-        target = Interface.factory(target_config)
+        # Several comma-separated targets fan out from a single download
+        targets = []
+        for name in args.get('target').split(','):
+            target_config = args.config[name]
+            target_config['name'] = name
+            targets.append(Interface.factory(target_config))
+        target = targets[0] if len(targets) == 1 else targets
 
     if command == 'find':
         query = args.input
         find(source, query)
     elif command == 'copy':
-        copy(source, target, worklist, anonymize)
+        copy(source, target, worklist, anonymize, max_workers, pipeline, journal, dedup)
     elif command == 'delete':
         delete(source, worklist)
     elif command == 'move':
-        move(source, target, worklist, anonymize)
+        move(source, target, worklist, anonymize, max_workers, pipeline, journal, dedup)
+    elif command == 'mirror' and args.incremental:
+        mirror_changes(source, target, args.state, anonymize=anonymize, max_workers=max_workers, pipeline=pipeline)
     elif command == 'mirror':
-        mirror(source, target, query, anonymize)
+        mirror(source, target, query, anonymize, max_workers, pipeline, journal, dedup)
     elif command == 'transfer':
-        transfer(source, target, query, anonymize)
+        transfer(source, target, query, anonymize, max_workers, pipeline, journal, dedup)
+    elif command == 'watch':
+        watch(source, target, args.state, anonymize=anonymize, max_workers=max_workers, poll_interval=args.poll)
     else:
         logger.error('Command %s not available')
         raise NotImplementedError